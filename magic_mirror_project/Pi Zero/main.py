@@ -10,6 +10,7 @@ import utime
 import network
 import gc
 import json
+import struct
 import ubinascii
 from machine import Pin, RTC
 
@@ -26,6 +27,7 @@ except ImportError:
     DISPLAY_HEIGHT = 320
     MQTT_BROKER = "test.mosquitto.org"
     MQTT_PORT = 1883
+    MQTT_KEEPALIVE = 60
     TOPIC_PREFIX = "magic_mirror_stable"
 
 # ==================== IMPORTAR FONT.PY ====================
@@ -101,7 +103,8 @@ except ImportError:
         def __init__(self, *args, **kwargs): pass
         def connect(self): raise Exception("MQTT não disponível")
         def disconnect(self): pass
-        def publish(self, topic, msg): pass
+        def publish(self, topic, msg, retain=False, qos=0): pass
+        def set_last_will(self, topic, msg, retain=False, qos=0): pass
         def subscribe(self, topic): pass
         def check_msg(self): pass
         def set_callback(self, callback): pass
@@ -249,6 +252,37 @@ def get_unique_device_id():
     except:
         return f"PICO_{utime.ticks_ms() % 100000}"
 
+# ==================== EVENTOS BINÁRIOS ====================
+# Formato mmb1 do servidor: 'MM', formato, ano u16, mês, dia, nº de eventos,
+# versão (u8 tamanho + ASCII); por evento: flags (bit 0 = dia inteiro),
+# minuto do dia u16, título (u8 tamanho + UTF-8)
+PAYLOAD_FORMATS = ['mmb1', 'json']
+
+def decode_events_binary(msg):
+    """Lê o payload mmb1 direto em tuplas (hora, título), sem passar por dicts"""
+    if msg[:2] != b'MM' or msg[2] != 1:
+        raise ValueError("payload mmb1 inválido")
+    count, vlen = msg[7], msg[8]
+    pos = 9
+    version = msg[pos:pos + vlen].decode()
+    pos += vlen
+    
+    events = []
+    for _ in range(count):
+        flags, minute, tlen = struct.unpack_from('>BHB', msg, pos)
+        pos += 4
+        title = msg[pos:pos + tlen].decode('utf-8')
+        pos += tlen
+        time_str = '' if flags & 1 else '%02d:%02d' % (minute // 60, minute % 60)
+        events.append((time_str, title))
+    return version, events
+
+def event_fields(event):
+    """(hora, título) de um evento em tupla (mmb1) ou dict (JSON)"""
+    if isinstance(event, tuple):
+        return event
+    return event.get('time', ''), event.get('title', 'Sem título')
+
 # ==================== NETWORK MANAGER ====================
 class NetworkManager:
     def __init__(self):
@@ -329,11 +363,16 @@ class MQTTManager:
         self.connected = False
         self.approved = False
         self.events = []
+        self.events_topic = None
+        self.group_id = None
         
         self.last_ping = 0
         self.last_registration = 0
+        self.last_heartbeat = 0
         self.ping_interval = 30000
         self.registration_interval = 60000
+        self.heartbeat_interval = 60000
+        self.presence_topic = None
         
         print(f"MQTT configurado:")
         print(f"  Device ID: {device_id}")
@@ -342,15 +381,15 @@ class MQTTManager:
     def mqtt_callback(self, topic, msg):
         try:
             topic_str = topic.decode('utf-8')
-            payload_str = msg.decode('utf-8')
             
             print(f"\n📨 MQTT:")
             print(f"  Topic: {topic_str}")
             
             if 'registration' in topic_str:
-                self._handle_registration(payload_str)
-            elif 'events' in topic_str:
-                self._handle_events(payload_str)
+                self._handle_registration(msg.decode('utf-8'))
+            elif topic_str == self.events_topic:
+                # Bytes crus: o payload pode ser binário (mmb1)
+                self._handle_events(msg)
         except Exception as e:
             print(f"❌ Erro callback: {e}")
     
@@ -376,35 +415,55 @@ class MQTTManager:
                 print(f"  Device ID: {device_id}")
                 print(f"  Topic: {self.topic_prefix}")
                 
-                events_topic = f"{self.topic_prefix}/devices/{device_id}/events"
-                try:
-                    self.client.subscribe(events_topic)
-                    print(f"  👂 Inscrito: {events_topic}")
-                except Exception as e:
-                    print(f"  ❌ Erro subscribe: {e}")
+                # Tópico do grupo vem do servidor (o broker faz o fan-out);
+                # mensagens de um grupo antigo são ignoradas pelo callback
+                events_topic = data.get('events_topic') or f"{self.topic_prefix}/devices/{device_id}/events"
+                self.group_id = data.get('group_id')
+                if events_topic != self.events_topic:
+                    try:
+                        self.client.subscribe(events_topic)
+                        self.events_topic = events_topic
+                        print(f"  👂 Inscrito: {events_topic}")
+                    except Exception as e:
+                        print(f"  ❌ Erro subscribe: {e}")
                 
         except Exception as e:
             print(f"❌ Erro registro: {e}")
     
     def _handle_events(self, payload):
         try:
-            data = json.loads(payload)
-            
-            if isinstance(data, dict) and 'events' in data:
-                self.events = data['events']
-            elif isinstance(data, list):
-                self.events = data
+            version = None
+            if payload[:2] == b'MM':
+                version, self.events = decode_events_binary(payload)
             else:
-                self.events = [data]
+                data = json.loads(payload.decode('utf-8'))
+                
+                if isinstance(data, dict) and 'events' in data:
+                    self.events = data['events']
+                    version = data.get('version')
+                elif isinstance(data, list):
+                    self.events = data
+                else:
+                    self.events = [data]
             
             print(f"\n✅ {len(self.events)} eventos recebidos")
             for i, event in enumerate(self.events[:3]):
-                title = event.get('title', 'Sem título')
-                time_str = event.get('time', '')
+                time_str, title = event_fields(event)
                 print(f"  {i+1}. {time_str} {title}")
+            
+            if version:
+                self._send_ack(version)
         except Exception as e:
             print(f"❌ Erro eventos: {e}")
     
+    def _send_ack(self, version):
+        """Confirma ao servidor qual versão dos eventos foi recebida"""
+        try:
+            ack = json.dumps({'version': version, 'group_id': self.group_id})
+            self.client.publish(f"{self.topic_prefix}/ack/{self.device_id}", ack)
+        except Exception as e:
+            print(f"❌ Erro ack: {e}")
+    
     def connect(self, network_manager):
         if not MQTT_AVAILABLE:
             print("❌ MQTT não disponível")
@@ -418,13 +477,22 @@ class MQTTManager:
             print(f"Conectando MQTT: {MQTT_BROKER}:{MQTT_PORT}")
             
             client_id = f"{self.device_id}_{utime.ticks_ms()}"
-            self.client = MQTTClient(client_id, MQTT_BROKER, port=MQTT_PORT)
+            self.client = MQTTClient(client_id, MQTT_BROKER, port=MQTT_PORT, keepalive=MQTT_KEEPALIVE)
             self.client.set_callback(self.mqtt_callback)
+            
+            # Presença: o broker publica "offline" (retido) se a conexão cair
+            self.presence_topic = f"{self.topic_prefix}/presence/{self.device_id}"
+            self.client.set_last_will(self.presence_topic, b'offline', retain=True)
+            
             self.client.connect()
             self.connected = True
+            self.events_topic = None  # sessão nova: reinscreve após o registro
             
             print(f"✅ MQTT conectado! ID: {client_id}")
             
+            self.client.publish(self.presence_topic, b'online', retain=True)
+            self.last_heartbeat = utime.ticks_ms()
+            
             registration_topic = f"{self.topic_prefix}/registration"
             self.client.subscribe(registration_topic)
             print(f"👂 Inscrito: {registration_topic}")
@@ -463,7 +531,9 @@ class MQTTManager:
                 'version': '3.0',
                 'capabilities': ['display', 'clock', 'calendar', 'events'],
                 'status': 'requesting_approval',
-                'mac_address': mac_address
+                'mac_address': mac_address,
+                'timezone_offset': TIMEZONE_OFFSET,
+                'formats': PAYLOAD_FORMATS
             }
             
             message = json.dumps(registration_data)
@@ -488,6 +558,10 @@ class MQTTManager:
                 self.client.ping()
                 self.last_ping = now
             
+            if utime.ticks_diff(now, self.last_heartbeat) > self.heartbeat_interval:
+                self.client.publish(self.presence_topic, b'hb')
+                self.last_heartbeat = now
+            
             if not self.approved and utime.ticks_diff(now, self.last_registration) > self.registration_interval:
                 self._send_registration()
             
@@ -500,6 +574,8 @@ class MQTTManager:
     def disconnect(self):
         if self.client:
             try:
+                # Desconexão limpa não dispara o last will: avisa por conta própria
+                self.client.publish(self.presence_topic, b'offline', retain=True)
                 self.client.disconnect()
             except:
                 pass
@@ -653,9 +729,10 @@ class MagicMirror:
         if events:
             events_text_lines.append("EVENTOS DE HOJE:")
             for i, event in enumerate(events[:max_events]):
-                if isinstance(event, dict):
-                    time_str = event.get('time', '').strip()
-                    title = event.get('title', 'Evento').strip()
+                if isinstance(event, (dict, tuple)):
+                    time_str, title = event_fields(event)
+                    time_str = time_str.strip()
+                    title = title.strip()
                     
                     # Normalizar texto para caracteres suportados
                     title = normalize_text(title)
@@ -7,13 +7,30 @@ Funciona com: Contas Pessoais, Corporativas e Estudantis
 import sqlite3
 import secrets
 import json
+import hashlib
+import heapq
 import threading
 import time
-from datetime import datetime, timedelta
+import queue
+import random
+import struct
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from urllib.parse import urlencode
 import os
 
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9: só offsets fixos
+    ZoneInfo = None
+
 from flask import Flask, request, jsonify, redirect, send_file
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import msal
 import paho.mqtt.client as mqtt
 from flask_cors import CORS
@@ -26,9 +43,90 @@ CORS(app, supports_credentials=True)
 MQTT_BROKER = "test.mosquitto.org"
 MQTT_PORT = 1883
 TOPIC_PREFIX = "space_mirror_hybrid"
-GRAPH_ENDPOINT = 'https://graph.microsoft.com/v1.0/'
+# GRAPH_ENDPOINT pode apontar para o mock local (mock_graph.py) em testes offline
+GRAPH_ENDPOINT = os.environ.get('GRAPH_ENDPOINT', 'https://graph.microsoft.com/v1.0/')
 REDIRECT_URI = "http://localhost:5000/callback"
 
+# Banco de dados (pool de conexões compartilhado entre Flask, MQTT e agendador)
+DB_PATH = 'mirror.db'
+DB_POOL_SIZE = 8              # conexões mantidas abertas no pool
+DB_BUSY_TIMEOUT = 5.0         # segundos aguardando um lock de escrita
+DB_STATEMENT_CACHE = 256      # statements preparados em cache por conexão
+
+# Renovação proativa de tokens (em segundos)
+TOKEN_RENEW_LEAD = 600        # renova quando faltar isso para expirar (no máximo meia vida do token)
+TOKEN_RENEW_JITTER = 60       # espalha renovações aleatoriamente
+TOKEN_RENEW_RETRY_MIN = 30    # backoff após falha: começa aqui...
+TOKEN_RENEW_RETRY_MAX = 900   # ...e dobra até este teto
+TOKEN_RENEW_MIN_INTERVAL = 60 # intervalo mínimo entre renovações bem-sucedidas
+
+# Cache de eventos (em segundos)
+EVENTS_CACHE_TTL = 300         # eventos considerados frescos
+EVENTS_CACHE_MAX_STALE = 3600  # além do TTL, serve o antigo enquanto revalida
+
+# Cliente HTTP do Graph (sessão keep-alive compartilhada)
+GRAPH_POOL_CONNECTIONS = 4     # hosts distintos mantidos no pool
+GRAPH_POOL_MAXSIZE = 16        # conexões simultâneas por host
+GRAPH_TIMEOUT = (5, 15)        # (conexão, leitura) em segundos
+GRAPH_RETRIES = 3              # tentativas extras em erros transitórios
+GRAPH_RETRY_BACKOFF = 0.5      # backoff exponencial entre tentativas
+GRAPH_BACKOFF_BASE = 2         # backoff após 429/5xx: 2s, 4s, 8s...
+GRAPH_BACKOFF_MAX = 120        # ...até este teto (se não houver Retry-After)
+GRAPH_MAX_WAIT = 10            # espera máxima de quem chama antes de desistir
+GRAPH_BREAKER_THRESHOLD = 5    # falhas seguidas que abrem o circuit breaker
+GRAPH_BREAKER_COOLDOWN = 300   # segundos com o circuito aberto
+GRAPH_BATCH_SIZE = 20          # limite do Graph por chamada $batch
+GRAPH_PAGE_SIZE = 20           # eventos por página ($top / odata.maxpagesize)
+EVENTS_FETCH_LIMIT = 200       # busca completa para de paginar ao atingir isso
+EVENTS_PREFETCH_DAYS = 3       # janela de dias buscada de uma vez (hoje + próximos)
+DEVICE_MAX_EVENTS = 20         # eventos enviados por dispositivo
+PAYLOAD_CACHE_SIZE = 256       # payloads codificados mantidos (versão, data, formato)
+PAYLOAD_FORMATS = ('mmb1', 'json')  # ordem de preferência; quem não negocia recebe JSON
+SYNC_WORKERS = 4               # grupos sincronizados em paralelo pelos jobs
+SYNC_JOB_TTL = 3600            # segundos que um job concluído fica consultável
+
+# Fuso dos dispositivos que não informam o seu (None = fuso do servidor)
+DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE')  # ex.: America/Sao_Paulo ou -03:00
+
+# Sincronização incremental via calendarView/delta (False = busca completa)
+CALENDAR_DELTA_SYNC = True
+
+# Notificações de alteração do Graph (webhook). Sem URL pública, só polling
+NOTIFICATION_URL = os.environ.get('NOTIFICATION_URL')  # ex.: https://mirror.exemplo.com/api/notifications
+SUBSCRIPTION_LIFETIME = 4230 * 60    # validade pedida ao Graph (máximo para eventos)
+SUBSCRIPTION_RENEW_LEAD = 3600       # renova quando faltar isso para expirar
+SUBSCRIPTION_CHECK_INTERVAL = 900    # revisão periódica das assinaturas
+SUBSCRIPTION_RETRY = 120             # nova tentativa após falha ao assinar
+NOTIFICATION_DEBOUNCE = 2            # agrupa rajadas de notificações da mesma caixa
+AUTO_SYNC_INTERVAL = 900             # polling sem webhook (15 minutos)
+AUTO_SYNC_INTERVAL_WEBHOOK = 3600    # polling de segurança com as assinaturas ativas
+
+# Ritmo das publicações MQTT (token bucket compartilhado pelo MQTTManager)
+MQTT_PUBLISH_RATE = 20             # mensagens por segundo...
+MQTT_PUBLISH_BURST = 40            # ...com rajadas de até isso
+MQTT_BYTES_RATE = 64 * 1024        # bytes por segundo...
+MQTT_BYTES_BURST = 256 * 1024      # ...com rajadas de até isso
+
+# Ingestão de registros (tópico público: filtra, deduplica e enfileira)
+REGISTRATION_WORKERS = 2           # threads que processam registros
+REGISTRATION_QUEUE_SIZE = 256      # registros aguardando; acima disso descarta
+REGISTRATION_MAX_BYTES = 4096      # payload maior que isso nem é decodificado
+REGISTRATION_DEDUP_WINDOW = 30     # ignora o mesmo registration_id por esse tempo (s)
+
+# Presença: last will + heartbeat do firmware em {prefix}/presence/{registration_id}
+PRESENCE_TIMEOUT = 180             # sem sinal por esse tempo = offline (heartbeat a cada 60s)
+
+# Confirmação de entrega: o firmware publica {prefix}/ack/{registration_id} com a versão exibida
+ACK_TIMEOUT = 30                   # publicação sem ack depois disso = dispositivo pendente (s)
+ACK_HISTORY = 50                   # latências guardadas por dispositivo
+
+# Agendador de sincronização por prazo
+SYNC_RATE = 5                  # grupos despachados por segundo, no máximo
+SYNC_JITTER = 0.1              # ±10% no intervalo de cada grupo para espalhar a carga
+SCHEDULER_REFRESH = 60         # releitura dos grupos aprovados (segundos)
+SCHEDULER_BUSY_RETRY = 1       # grupo vencido já sincronizando: tenta de novo depois disso
+SCHEDULER_BATCH_WINDOW = 5     # grupos que vencem nesse intervalo saem juntos (um $batch)
+
 # Scopes para delegated permissions (IMPORTANTE: usar openid e offline_access)
 DELEGATED_SCOPES = ['openid', 'profile', 'email', 'offline_access', 'Calendars.Read']
 
@@ -44,60 +142,231 @@ print("   • SEM Client Secret → Delegated Permissions (Login Interativo)")
 print("="*70)
 print(f"📡 MQTT: {MQTT_BROKER}:{MQTT_PORT}")
 print(f"🔗 Redirect: {REDIRECT_URI}")
+print(f"🔔 Webhook: {NOTIFICATION_URL or 'desativado (defina NOTIFICATION_URL)'}")
 print("="*70 + "\n")
 
 # Banco de dados
+class ConnectionPool:
+    """Pool de conexões SQLite em modo WAL, compartilhado entre threads"""
+    
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=size)
+    
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão do pool (commit ao sair, rollback em erro)"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+db_pool = ConnectionPool(DB_PATH)
+
+def get_db():
+    """Uso: with get_db() as conn: ..."""
+    return db_pool.connection()
+
 def init_db():
-    conn = sqlite3.connect('mirror.db')
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS config (
-        id INTEGER PRIMARY KEY,
-        client_id TEXT,
-        tenant_id TEXT,
-        client_secret TEXT,
-        user_email TEXT,
-        access_token TEXT,
-        refresh_token TEXT,
-        expires_at TEXT,
-        user_name TEXT,
-        auth_mode TEXT DEFAULT 'delegated'
-    )''')
-    
-    # Verifica e adiciona colunas necessárias
-    c.execute("PRAGMA table_info(config)")
-    cols = [col[1] for col in c.fetchall()]
-    
-    if 'user_name' not in cols:
-        c.execute('ALTER TABLE config ADD COLUMN user_name TEXT')
-    if 'client_secret' not in cols:
-        c.execute('ALTER TABLE config ADD COLUMN client_secret TEXT')
-    if 'tenant_id' not in cols:
-        c.execute('ALTER TABLE config ADD COLUMN tenant_id TEXT')
-    if 'auth_mode' not in cols:
-        c.execute('ALTER TABLE config ADD COLUMN auth_mode TEXT DEFAULT "delegated"')
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS devices (
-        registration_id TEXT PRIMARY KEY,
-        device_id TEXT,
-        status TEXT DEFAULT 'pending',
-        device_info TEXT,
-        mac_address TEXT,
-        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    c.execute('INSERT OR IGNORE INTO config (id) VALUES (1)')
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS config (
+            id INTEGER PRIMARY KEY,
+            client_id TEXT,
+            tenant_id TEXT,
+            client_secret TEXT,
+            user_email TEXT,
+            access_token TEXT,
+            refresh_token TEXT,
+            expires_at TEXT,
+            user_name TEXT,
+            auth_mode TEXT DEFAULT 'delegated'
+        )''')
+        
+        # Verifica e adiciona colunas necessárias
+        c.execute("PRAGMA table_info(config)")
+        cols = [col[1] for col in c.fetchall()]
+        
+        if 'user_name' not in cols:
+            c.execute('ALTER TABLE config ADD COLUMN user_name TEXT')
+        if 'client_secret' not in cols:
+            c.execute('ALTER TABLE config ADD COLUMN client_secret TEXT')
+        if 'tenant_id' not in cols:
+            c.execute('ALTER TABLE config ADD COLUMN tenant_id TEXT')
+        if 'auth_mode' not in cols:
+            c.execute('ALTER TABLE config ADD COLUMN auth_mode TEXT DEFAULT "delegated"')
+        if 'msal_cache' not in cols:
+            c.execute('ALTER TABLE config ADD COLUMN msal_cache TEXT')
+        
+        c.execute('''CREATE TABLE IF NOT EXISTS devices (
+            registration_id TEXT PRIMARY KEY,
+            device_id TEXT,
+            status TEXT DEFAULT 'pending',
+            device_info TEXT,
+            mac_address TEXT,
+            first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        
+        # Caixa de correio exibida por cada dispositivo (NULL = user_email da config)
+        c.execute("PRAGMA table_info(devices)")
+        dev_cols = [col[1] for col in c.fetchall()]
+        if 'mailbox' not in dev_cols:
+            c.execute('ALTER TABLE devices ADD COLUMN mailbox TEXT')
+        # Fuso do dispositivo: nome IANA ou offset '+HH:MM' (NULL = DEFAULT_TIMEZONE)
+        if 'timezone' not in dev_cols:
+            c.execute('ALTER TABLE devices ADD COLUMN timezone TEXT')
+        # Origem do fuso: 'admin' (definido pela API, prevalece) ou NULL (informado pelo firmware)
+        if 'timezone_source' not in dev_cols:
+            c.execute('ALTER TABLE devices ADD COLUMN timezone_source TEXT')
+        # Formato do payload de eventos negociado no registro (NULL = json)
+        if 'payload_format' not in dev_cols:
+            c.execute('ALTER TABLE devices ADD COLUMN payload_format TEXT')
+        
+        # Estado da sincronização incremental (delta link + conjunto local de eventos)
+        c.execute('''CREATE TABLE IF NOT EXISTS calendar_delta (
+            sync_key TEXT PRIMARY KEY,
+            delta_link TEXT,
+            events TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        
+        # Assinaturas de notificação do Graph, uma por caixa monitorada
+        c.execute('''CREATE TABLE IF NOT EXISTS subscriptions (
+            mailbox TEXT PRIMARY KEY,
+            subscription_id TEXT,
+            resource TEXT,
+            client_state TEXT,
+            expires_at TEXT
+        )''')
+        
+        c.execute('INSERT OR IGNORE INTO config (id) VALUES (1)')
     print("✅ Banco de dados inicializado\n")
 
 init_db()
 
-def get_db():
-    conn = sqlite3.connect('mirror.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+class ConfigCache:
+    """Cópia em memória da linha de config (id = 1) com write-through"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+    
+    def get(self):
+        """Retorna o snapshot atual (somente leitura) sem tocar no SQLite"""
+        data = self._data
+        if data is None:
+            data = self.reload()
+        return data
+    
+    def reload(self):
+        with self._lock:
+            with get_db() as conn:
+                row = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
+            self._data = dict(row) if row else {}
+            return self._data
+    
+    def update(self, **fields):
+        """Grava os campos no banco e troca o snapshot de forma atômica"""
+        with self._lock:
+            cols = ', '.join(f'{k} = ?' for k in fields)
+            with get_db() as conn:
+                conn.execute(f'UPDATE config SET {cols} WHERE id = 1', tuple(fields.values()))
+                row = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
+            self._data = dict(row) if row else {}
+            return self._data
+
+config_cache = ConfigCache()
+
+class SingleFlight:
+    """Uma execução em andamento por chave; chamadas concorrentes aguardam o mesmo resultado"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, fn, join=True):
+        """Com join=False não aproveita a execução em andamento: espera ela acabar e roda a própria"""
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = {'done': threading.Event(), 'result': None, 'error': None}
+                    self._calls[key] = call
+            
+            if leader:
+                break
+            call['done'].wait()
+            if join:
+                if call['error']:
+                    raise call['error']
+                return call['result']
+        
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['done'].set()
+    
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+class TokenBucket:
+    """Limitador de vazão: 'rate' fichas por segundo, acumulando até 'capacity'"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, amount=1):
+        """Reserva 'amount' fichas, dormindo o necessário; retorna a espera em segundos"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserva já: o saldo pode ficar negativo e quem vier depois espera mais
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait > 0:
+            time.sleep(wait)
+        return wait
 
 # ============================================================================
 # SISTEMA DE DETECÇÃO AUTOMÁTICA DE MODO
@@ -105,9 +374,7 @@ def get_db():
 
 def detect_auth_mode():
     """Detecta automaticamente qual modo de autenticação usar"""
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
-    conn.close()
+    cfg = config_cache.get()
     
     if not cfg or not cfg['client_id']:
         return None, "Não configurado"
@@ -126,11 +393,13 @@ def detect_auth_mode():
 # MSAL - GERENCIAMENTO HÍBRIDO
 # ============================================================================
 
+# App MSAL reaproveitado enquanto (client_id, tenant, secret) não mudar
+_msal_lock = threading.Lock()
+_msal_state = {'key': None, 'app': None, 'mode': None}
+
 def get_msal_app():
-    """Cria o app MSAL apropriado baseado na configuração"""
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
-    conn.close()
+    """Retorna o app MSAL apropriado, recriando-o só quando a configuração muda"""
+    cfg = config_cache.get()
     
     if not cfg or not cfg['client_id']:
         return None, None
@@ -144,50 +413,100 @@ def get_msal_app():
     if cfg['tenant_id'] and cfg['tenant_id'] not in ['common', 'consumers']:
         tenant = cfg['tenant_id']
     
-    authority = f"https://login.microsoftonline.com/{tenant}"
+    key = (cfg['client_id'], tenant, cfg['client_secret'])
     
-    # Se tem Client Secret, usa ConfidentialClientApplication
-    if cfg['client_secret']:
-        app = msal.ConfidentialClientApplication(
-            cfg['client_id'],
-            authority=authority,
-            client_credential=cfg['client_secret']
-        )
-        return app, 'application'
-    
-    # Se não tem Client Secret, usa PublicClientApplication
-    else:
-        app = msal.PublicClientApplication(
-            cfg['client_id'],
-            authority=authority
-        )
-        return app, 'delegated'
+    with _msal_lock:
+        if _msal_state['key'] == key:
+            return _msal_state['app'], _msal_state['mode']
+        
+        authority = f"https://login.microsoftonline.com/{tenant}"
+        
+        # Cache de tokens do MSAL persistido no SQLite (sobrevive a reinícios)
+        token_cache = msal.SerializableTokenCache()
+        if cfg.get('msal_cache'):
+            try:
+                token_cache.deserialize(cfg['msal_cache'])
+            except Exception as e:
+                print(f"⚠️ Cache MSAL inválido, ignorando: {e}")
+        
+        # Se tem Client Secret, usa ConfidentialClientApplication
+        if cfg['client_secret']:
+            app = msal.ConfidentialClientApplication(
+                cfg['client_id'],
+                authority=authority,
+                client_credential=cfg['client_secret'],
+                token_cache=token_cache
+            )
+            mode = 'application'
+        
+        # Se não tem Client Secret, usa PublicClientApplication
+        else:
+            app = msal.PublicClientApplication(
+                cfg['client_id'],
+                authority=authority,
+                token_cache=token_cache
+            )
+            mode = 'delegated'
+        
+        _msal_state.update(key=key, app=app, mode=mode)
+        print(f"🔑 App MSAL criado ({mode}) - authority: {authority}")
+        return app, mode
+
+def save_msal_cache(app):
+    """Persiste o cache de tokens do MSAL se ele mudou"""
+    token_cache = app.token_cache
+    if token_cache.has_state_changed:
+        config_cache.update(msal_cache=token_cache.serialize())
+        token_cache.has_state_changed = False
+
+def reset_msal_app():
+    """Descarta o app MSAL em memória (próxima chamada recria a partir da config)"""
+    with _msal_lock:
+        _msal_state.update(key=None, app=None, mode=None)
+
+# Uma renovação em andamento por credencial
+_token_flight = SingleFlight()
+
+def _cached_token(cfg, margin=timedelta(minutes=5)):
+    """Retorna o access token da config se ainda válido por mais que 'margin'"""
+    if cfg['access_token'] and cfg['expires_at']:
+        try:
+            exp = datetime.fromisoformat(cfg['expires_at'])
+            if datetime.now() < exp - margin:
+                return cfg['access_token']
+        except:
+            pass
+    return None
 
 def get_valid_token():
     """Obtém token válido usando o modo apropriado"""
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
+    cfg = config_cache.get()
     
     if not cfg or not cfg['client_id']:
-        conn.close()
         return None
     
     # Verifica se tem token válido em cache
-    if cfg['access_token'] and cfg['expires_at']:
-        try:
-            exp = datetime.fromisoformat(cfg['expires_at'])
-            if datetime.now() < exp - timedelta(minutes=5):
-                token = cfg['access_token']
-                conn.close()
-                return token
-        except:
-            pass
+    token = _cached_token(cfg)
+    if token:
+        return token
+    
+    # Token expirado ou não existe - uma única renovação por credencial,
+    # chamadas concorrentes aguardam o resultado dela
+    key = (cfg['client_id'], cfg['tenant_id'], cfg['client_secret'])
+    return _token_flight.do(key, _renew_token)
+
+def _renew_token(margin=timedelta(minutes=5)):
+    """Renova o token via MSAL (executado dentro do single-flight)"""
+    cfg = config_cache.get()
+    
+    # Outra thread pode ter renovado enquanto esperávamos
+    token = _cached_token(cfg, margin)
+    if token:
+        return token
     
-    # Token expirado ou não existe - precisa renovar
     app, mode = get_msal_app()
     
     if not app:
-        conn.close()
         return None
     
     # ============================================================================
@@ -195,141 +514,1039 @@ def get_valid_token():
     # ============================================================================
     if mode == 'application' and cfg['client_secret']:
         try:
+            # Desde o MSAL 1.23 o cache é consultado antes da rede; descarta
+            # do cache os tokens que expiram dentro da margem pedida
+            now = time.time()
+            for at in list(app.token_cache.search(msal.TokenCache.CredentialType.ACCESS_TOKEN)):
+                if int(at.get('expires_on', 0)) - now < margin.total_seconds():
+                    app.token_cache.remove_at(at)
+            
             result = app.acquire_token_for_client(scopes=APPLICATION_SCOPES)
+            save_msal_cache(app)
             
             if result and "access_token" in result:
                 token = result['access_token']
                 expires_in = result.get('expires_in', 3600)
                 expires_at = (datetime.now() + timedelta(seconds=expires_in)).isoformat()
                 
-                conn.execute('UPDATE config SET access_token = ?, expires_at = ?, auth_mode = ? WHERE id = 1', 
-                            (token, expires_at, 'application'))
-                conn.commit()
-                conn.close()
+                config_cache.update(access_token=token, expires_at=expires_at, auth_mode='application')
                 
                 print("✅ Token obtido via Application Permissions")
                 return token
             else:
                 error = result.get('error_description', 'Erro desconhecido')
                 print(f"❌ Erro Application: {error}")
-                conn.close()
                 return None
                 
         except Exception as e:
             print(f"❌ Erro ao obter token Application: {e}")
-            conn.close()
             return None
     
     # ============================================================================
     # MODO DELEGATED - Refresh Token Flow
     # ============================================================================
     elif mode == 'delegated':
-        # Tenta usar refresh token se disponível
-        if cfg['refresh_token']:
-            try:
+        try:
+            # Primeiro tenta o cache do MSAL (renova sozinho via refresh token)
+            result = None
+            accounts = app.get_accounts()
+            if accounts:
+                result = app.acquire_token_silent(DELEGATED_SCOPES, account=accounts[0], force_refresh=True)
+            
+            # Fallback: refresh token salvo na config
+            if not (result and "access_token" in result) and cfg['refresh_token']:
                 result = app.acquire_token_by_refresh_token(
                     cfg['refresh_token'],
                     scopes=DELEGATED_SCOPES
                 )
+            save_msal_cache(app)
+            
+            if result and "access_token" in result:
+                token = result['access_token']
+                expires_in = result.get('expires_in', 3600)
+                expires_at = (datetime.now() + timedelta(seconds=expires_in)).isoformat()
                 
-                if result and "access_token" in result:
-                    token = result['access_token']
-                    expires_in = result.get('expires_in', 3600)
-                    expires_at = (datetime.now() + timedelta(seconds=expires_in)).isoformat()
-                    
-                    conn.execute('''UPDATE config SET 
-                                  access_token = ?, 
-                                  refresh_token = ?,
-                                  expires_at = ?,
-                                  auth_mode = ?
-                                  WHERE id = 1''', 
-                               (token,
-                                result.get('refresh_token', cfg['refresh_token']),
-                                expires_at,
-                                'delegated'))
-                    conn.commit()
-                    conn.close()
-                    
-                    print("✅ Token renovado via Delegated Permissions")
-                    return token
-            except Exception as e:
-                print(f"⚠️ Falha ao renovar token: {e}")
+                config_cache.update(
+                    access_token=token,
+                    refresh_token=result.get('refresh_token', cfg['refresh_token']),
+                    expires_at=expires_at,
+                    auth_mode='delegated'
+                )
+                
+                print("✅ Token renovado via Delegated Permissions")
+                return token
+        except Exception as e:
+            print(f"⚠️ Falha ao renovar token: {e}")
         
         # Se não tem refresh token ou falhou, precisa fazer login
-        conn.close()
         return None
     
-    conn.close()
     return None
 
+# ============================================================================
+# RENOVAÇÃO PROATIVA DE TOKENS
+# ============================================================================
+
+# Acordado quando a configuração/login muda, para reagendar a renovação
+token_renewer_wakeup = threading.Event()
+
+def _renewal_lead(lifetime):
+    """Antecedência da renovação: tokens curtos (ex.: 10 min) renovam na metade da vida"""
+    lead = TOKEN_RENEW_LEAD if lifetime is None else min(TOKEN_RENEW_LEAD, lifetime / 2)
+    return lead + random.uniform(0, min(TOKEN_RENEW_JITTER, lead / 2))
+
+def _next_renewal_delay(failures, lead):
+    """Segundos até a próxima tentativa de renovação"""
+    if failures:
+        backoff = min(TOKEN_RENEW_RETRY_MAX, TOKEN_RENEW_RETRY_MIN * 2 ** (failures - 1))
+        return backoff + random.uniform(0, TOKEN_RENEW_JITTER)
+    
+    cfg = config_cache.get()
+    if not cfg.get('client_id') or not cfg.get('expires_at'):
+        return TOKEN_RENEW_RETRY_MAX
+    
+    try:
+        exp = datetime.fromisoformat(cfg['expires_at'])
+    except ValueError:
+        return 0
+    
+    due = exp - timedelta(seconds=lead)
+    return max(0, (due - datetime.now()).total_seconds())
+
+def token_renewer():
+    """Renova tokens (delegated e application) antes de expirarem"""
+    failures = 0
+    lead = _renewal_lead(None)  # vida do token desconhecida até a primeira renovação
+    floor = 0
+    while True:
+        token_renewer_wakeup.wait(max(floor, _next_renewal_delay(failures, lead)))
+        token_renewer_wakeup.clear()
+        floor = 0
+        
+        cfg = config_cache.get()
+        if not cfg.get('client_id'):
+            failures = 0
+            continue
+        
+        # Delegated sem login: nada para renovar até o usuário entrar
+        if not cfg['client_secret'] and not cfg['refresh_token'] and not cfg.get('msal_cache'):
+            failures = 0
+            continue
+        
+        margin = timedelta(seconds=lead)
+        if _cached_token(cfg, margin):
+            failures = 0
+            continue
+        
+        try:
+            key = (cfg['client_id'], cfg['tenant_id'], cfg['client_secret'])
+            token = _token_flight.do(key, lambda: _renew_token(margin))
+        except Exception as e:
+            print(f"❌ Erro na renovação proativa: {e}")
+            token = None
+        
+        if token:
+            failures = 0
+            floor = TOKEN_RENEW_MIN_INTERVAL
+            try:
+                lifetime = (datetime.fromisoformat(config_cache.get()['expires_at'])
+                            - datetime.now()).total_seconds()
+                lead = _renewal_lead(lifetime)
+            except (TypeError, ValueError):
+                pass
+        else:
+            failures += 1
+            print(f"⚠️ Renovação proativa falhou ({failures}x) - nova tentativa com backoff")
+
+threading.Thread(target=token_renewer, daemon=True).start()
+
+# ============================================================================
+# CLIENTE MICROSOFT GRAPH
+# ============================================================================
+
+class GraphError(Exception):
+    """Resposta HTTP de erro do Graph"""
+    
+    def __init__(self, status, message=''):
+        super().__init__(f"{status} {message}".strip())
+        self.status = status
+        self.message = message
+    
+    @classmethod
+    def from_response(cls, res):
+        try:
+            message = res.json().get('error', {}).get('message', '')
+        except ValueError:
+            message = ''
+        return cls(res.status_code, message)
+
+class GraphUnavailable(GraphError):
+    """Graph bloqueado localmente (throttling ou circuit breaker aberto)"""
+    
+    def __init__(self, message):
+        super().__init__(None, message)
+
+class GraphThrottle:
+    """Limitador compartilhado: Retry-After, backoff exponencial e circuit breaker"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.blocked_until = 0.0
+        self.open_until = 0.0
+    
+    def acquire(self):
+        """Aguarda a liberação ou levanta GraphUnavailable se a espera for longa"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.open_until:
+                raise GraphUnavailable(f"circuito aberto por mais {self.open_until - now:.0f}s")
+            wait = self.blocked_until - now
+        
+        if wait > GRAPH_MAX_WAIT:
+            raise GraphUnavailable(f"throttling por mais {wait:.0f}s")
+        if wait > 0:
+            time.sleep(wait)
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+    
+    def record_failure(self, retry_after=None):
+        with self._lock:
+            now = time.monotonic()
+            self.failures += 1
+            delay = retry_after or min(GRAPH_BACKOFF_MAX, GRAPH_BACKOFF_BASE * 2 ** (self.failures - 1))
+            self.blocked_until = max(self.blocked_until, now + delay)
+            
+            if self.failures >= GRAPH_BREAKER_THRESHOLD and now >= self.open_until:
+                self.open_until = now + GRAPH_BREAKER_COOLDOWN
+                print(f"🚧 Graph: {self.failures} falhas seguidas - circuito aberto por {GRAPH_BREAKER_COOLDOWN}s")
+    
+    def is_open(self):
+        return time.monotonic() < self.open_until
+
+class GraphClient:
+    """Sessão HTTP com pool de conexões usada por todas as chamadas ao Graph"""
+    
+    def __init__(self):
+        retry = Retry(
+            total=GRAPH_RETRIES,
+            backoff_factor=GRAPH_RETRY_BACKOFF,
+            # 429/503 ficam com o GraphThrottle (Retry-After compartilhado)
+            status_forcelist=(500, 502, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=False,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=GRAPH_POOL_CONNECTIONS,
+            pool_maxsize=GRAPH_POOL_MAXSIZE,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.throttle = GraphThrottle()
+    
+    def url(self, path):
+        """Aceita caminho relativo ao GRAPH_ENDPOINT ou URL completa (nextLink/deltaLink)"""
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return GRAPH_ENDPOINT + path.lstrip('/')
+    
+    def get(self, path, token, params=None, headers=None):
+        return self._send('GET', path, token, params=params, headers=headers)
+    
+    def post(self, path, token, body, headers=None):
+        return self._send('POST', path, token, json=body, headers=headers)
+    
+    def patch(self, path, token, body, headers=None):
+        return self._send('PATCH', path, token, json=body, headers=headers)
+    
+    def delete(self, path, token, headers=None):
+        return self._send('DELETE', path, token, headers=headers)
+    
+    def _send(self, method, path, token, headers=None, **kwargs):
+        all_headers = {'Authorization': f'Bearer {token}'}
+        all_headers.update(headers or {})
+        
+        self.throttle.acquire()
+        try:
+            res = self.session.request(method, self.url(path), headers=all_headers,
+                                       timeout=GRAPH_TIMEOUT, **kwargs)
+        except requests.RequestException:
+            self.throttle.record_failure()
+            raise
+        
+        self.record_status(res.status_code, res.headers)
+        return res
+    
+    def record_status(self, status, headers):
+        """Alimenta o throttle com o status de uma resposta (ou sub-resposta de $batch)"""
+        if status in (429, 503):
+            retry_after = str((headers or {}).get('Retry-After', ''))
+            self.throttle.record_failure(int(retry_after) if retry_after.isdigit() else None)
+            print(f"⏳ Graph throttling ({status}) - Retry-After: {retry_after or '-'}")
+        elif status >= 500:
+            self.throttle.record_failure()
+        else:
+            self.throttle.record_success()
+    
+    def batch(self, token, requests_):
+        """Envia até GRAPH_BATCH_SIZE requisições num único $batch; retorna {id: resposta}"""
+        res = self.post('$batch', token, {'requests': requests_})
+        if res.status_code != 200:
+            raise GraphError(res.status_code, 'Falha no $batch')
+        
+        responses = {}
+        for sub in res.json().get('responses', []):
+            self.record_status(sub.get('status', 500), sub.get('headers'))
+            responses[sub['id']] = sub
+        return responses
+    
+    def relative(self, url, params=None):
+        """URL relativa à versão da API, como exigido dentro de um $batch"""
+        if url.startswith(GRAPH_ENDPOINT):
+            url = url[len(GRAPH_ENDPOINT):]
+        url = '/' + url.lstrip('/')
+        if params:
+            url += ('&' if '?' in url else '?') + urlencode(params)
+        return url
+    
+    def iter_pages(self, path, token, params=None, headers=None):
+        """Gera as páginas de uma coleção, seguindo @odata.nextLink sob demanda"""
+        url = path
+        while url:
+            res = self.get(url, token, params=params, headers=headers)
+            if res.status_code != 200:
+                raise GraphError.from_response(res)
+            
+            page = res.json()
+            yield page
+            url, params = page.get('@odata.nextLink'), None
+
+graph = GraphClient()
+
 # ============================================================================
 # OBTENÇÃO DE EVENTOS DO CALENDÁRIO
 # ============================================================================
 
-def get_today_events():
-    """Obtém eventos do dia usando o endpoint apropriado"""
+class CalendarIndex:
+    """Eventos de uma janela de dias indexados por data local (lookup O(1))"""
+    
+    def __init__(self, first_day, days, events, tz):
+        self.first_day = first_day
+        self.last_day = first_day + timedelta(days=days - 1)
+        self.by_day = {}
+        
+        for e in events:
+            for day in _event_days(e, tz):
+                if self.first_day <= day <= self.last_day:
+                    self.by_day.setdefault(day, []).append(_format_event(e, tz, day))
+        
+        # Dia inteiro primeiro, depois por horário; a versão identifica o conteúdo
+        self.versions = {}
+        for day, day_events in self.by_day.items():
+            day_events.sort(key=lambda x: x.get('time', '23:59'))
+            content = json.dumps(day_events, ensure_ascii=False, sort_keys=True)
+            self.versions[day] = hashlib.sha1(content.encode()).hexdigest()[:16]
+    
+    def covers(self, day):
+        return self.first_day <= day <= self.last_day
+    
+    def events_for(self, day):
+        return self.by_day.get(day, [])
+    
+    def version(self, day):
+        return self.versions.get(day, 'empty')
+
+class EventsCache:
+    """Índices de eventos por (caixa, fuso) com TTL e stale-while-revalidate"""
+    
+    def __init__(self, ttl=EVENTS_CACHE_TTL, max_stale=EVENTS_CACHE_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._lock = threading.Lock()
+        self._entries = {}        # key -> (CalendarIndex, fetched_at)
+        self._refreshing = set()  # chaves com revalidação em background
+        self._invalid = set()     # chaves marcadas por notificação de alteração
+        self._flight = SingleFlight()
+    
+    def get(self, key, loader, day, fresh=False):
+        """Índice que cobre 'day' ('loader': índice novo ou None); 'fresh' não serve vencido"""
+        entry = self._entries.get(key)
+        if entry and entry[0].covers(day) and key not in self._invalid:
+            age = time.monotonic() - entry[1]
+            # No último dia da janela já busca a próxima em background,
+            # assim a virada do dia não depende do Graph
+            if age < self.ttl and day < entry[0].last_day:
+                return entry[0]
+            if age < (self.ttl if fresh else self.ttl + self.max_stale):
+                self._revalidate(key, loader, day)
+                return entry[0]
+        
+        # Miss (ou velho demais): busca síncrona, colapsada por chave e dia
+        return self._flight.do((key, day), lambda: self._load(key, loader))
+    
+    def _load(self, key, loader):
+        index = loader()
+        with self._lock:
+            if index is None:
+                # Falha: mantém o último valor conhecido
+                entry = self._entries.get(key)
+                return entry[0] if entry else None
+            
+            now = time.monotonic()
+            self._entries[key] = (index, now)
+            self._invalid.discard(key)
+            limit = self.ttl + self.max_stale
+            for k in [k for k, (_, t) in self._entries.items() if now - t > limit]:
+                del self._entries[k]
+            return index
+    
+    def _revalidate(self, key, loader, day):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        
+        def run():
+            try:
+                self._flight.do((key, day), lambda: self._load(key, loader))
+            except Exception as e:
+                print(f"❌ Erro revalidando eventos: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def put(self, key, index):
+        """Grava um índice obtido por fora (ex.: $batch) como fresco"""
+        self._load(key, lambda: index)
+    
+    def is_fresh(self, key, day):
+        entry = self._entries.get(key)
+        return (bool(entry) and entry[0].covers(day) and day < entry[0].last_day
+                and time.monotonic() - entry[1] < self.ttl)
+    
+    def invalidate(self, mailbox):
+        """Força a próxima leitura da caixa a ir ao Graph (o valor antigo fica de fallback)"""
+        with self._lock:
+            self._invalid.update(k for k in self._entries if k[0] == mailbox)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._invalid.clear()
+
+events_cache = EventsCache()
+
+def parse_timezone(value):
+    """tzinfo de um nome IANA ('America/Sao_Paulo') ou offset em horas ('-3', '+05:30'); None se inválido"""
+    value = str(value).strip()
+    if value.upper() in ('UTC', 'Z'):
+        return timezone.utc
+    
+    if value[:1] not in '+-0123456789':
+        if not ZoneInfo:
+            return None
+        try:
+            return ZoneInfo(value)
+        except (ValueError, LookupError):
+            return None
+    
+    try:
+        sign = -1 if value.startswith('-') else 1
+        hours, _, minutes = value.lstrip('+-').partition(':')
+        offset = timedelta(hours=float(hours), minutes=int(minutes or 0))
+        return timezone(sign * offset)
+    except ValueError:
+        return None
+
+def timezone_key(value):
+    """Forma canônica do fuso (gravada no banco e usada nas chaves de cache)"""
+    if value is None or value == '':
+        return None
+    tz = parse_timezone(value)
+    if tz is None:
+        return None
+    if ZoneInfo and isinstance(tz, ZoneInfo):
+        return tz.key
+    
+    minutes = int(tz.utcoffset(None).total_seconds() // 60)
+    sign = '-' if minutes < 0 else '+'
+    return f"{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+
+def resolve_timezone(value=None):
+    """(chave, tzinfo) do fuso do dispositivo, caindo no padrão se ausente/inválido"""
+    key = timezone_key(value) or timezone_key(DEFAULT_TIMEZONE)
+    if key:
+        return key, parse_timezone(key)
+    
+    local = datetime.now().astimezone().tzinfo
+    key = timezone_key(local.utcoffset(None).total_seconds() / 3600)
+    return key, parse_timezone(key)
+
+def local_today(tz_value=None):
+    """Data de hoje no fuso do dispositivo"""
+    return datetime.now(resolve_timezone(tz_value)[1]).date()
+
+def _graph_utc(dt):
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _window(first_day, tz):
+    """Janela [first_day, first_day + EVENTS_PREFETCH_DAYS) do fuso 'tz', em UTC"""
+    start = datetime.combine(first_day, datetime.min.time(), tzinfo=tz)
+    end = datetime.combine(first_day + timedelta(days=EVENTS_PREFETCH_DAYS), datetime.min.time(), tzinfo=tz)
+    return _graph_utc(start), _graph_utc(end)
+
+def _index_loader(auth_mode, mailbox, first_day, tz):
+    """Função que busca a janela a partir de 'first_day' e monta o índice"""
+    def load():
+        start, end = _window(first_day, tz)
+        events = fetch_events(auth_mode, mailbox, start, end)
+        if events is None:
+            return None
+        return CalendarIndex(first_day, EVENTS_PREFETCH_DAYS, events, tz)
+    return load
+
+def resolve_mailbox(mailbox=None):
+    """(auth_mode, caixa efetivamente lida) para a caixa configurada no dispositivo"""
+    cfg = config_cache.get()
+    auth_mode = cfg['auth_mode'] if cfg else 'delegated'
+    
+    # Só o modo application lê outras caixas; delegated sempre usa /me
+    if not mailbox or auth_mode != 'application':
+        mailbox = cfg['user_email'] if cfg else None
+    return auth_mode, mailbox
+
+def get_day_snapshot(day, mailbox=None, tz=None, fresh=False):
+    """(versão, eventos) do dia local 'day' no fuso 'tz', via índice em cache"""
+    auth_mode, mailbox = resolve_mailbox(mailbox)
+    tz_key, tzinfo = resolve_timezone(tz)
+    index = events_cache.get((mailbox or 'me', tz_key),
+                             _index_loader(auth_mode, mailbox, day, tzinfo), day, fresh)
+    if not index:
+        return 'empty', []
+    return index.version(day), index.events_for(day)
+
+def get_events_for_day(day, limit=None, mailbox=None, tz=None):
+    """Eventos do dia local 'day' no fuso 'tz', no máximo 'limit'"""
+    return get_day_snapshot(day, mailbox, tz)[1][:limit]
+
+def get_today_events(limit=None, mailbox=None, tz=None):
+    """Obtém eventos do dia (no fuso 'tz'), no máximo 'limit'"""
+    return get_events_for_day(local_today(tz), limit, mailbox, tz)
+
+def prefetch_events(devices):
+    """Aquece o cache dos grupos (caixa, fuso) de vários dispositivos via $batch (modo application)"""
+    cfg = config_cache.get()
+    if cfg.get('auth_mode') != 'application':
+        return
+    
+    pending = {}
+    for mailbox, tz in devices:
+        _, mailbox = resolve_mailbox(mailbox)
+        tz_key, tzinfo = resolve_timezone(tz)
+        day = datetime.now(tzinfo).date()
+        if mailbox and not events_cache.is_fresh((mailbox, tz_key), day):
+            pending[(mailbox, tz_key)] = (day, tzinfo)
+    if len(pending) < 2:
+        return
+    
     token = get_valid_token()
     if not token:
-        print("❌ Token não disponível para buscar eventos")
-        return []
+        return
     
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
-    auth_mode = cfg['auth_mode'] if cfg else 'delegated'
-    user_email = cfg['user_email'] if cfg else None
-    conn.close()
+    # Fusos com o mesmo offset hoje geram a mesma janela: uma consulta só
+    queries = {key: (key[0],) + _window(day, tzinfo) for key, (day, tzinfo) in pending.items()}
+    results = fetch_events_batch(token, sorted(set(queries.values())))
+    for key, query in queries.items():
+        events = results.get(query)
+        if events is not None:
+            day, tzinfo = pending[key]
+            events_cache.put(key, CalendarIndex(day, EVENTS_PREFETCH_DAYS, events, tzinfo))
+
+def _parse_graph_datetime(value):
+    return datetime.fromisoformat(value['dateTime'].replace('Z', '')[:26])
+
+def _local_datetime(e, field, tz):
+    """Horário do evento no fuso 'tz' (o Graph devolve em UTC)"""
+    dt = _parse_graph_datetime(e[field])
+    if e.get('isAllDay'):
+        return dt  # dia inteiro é "flutuante": a data vale em qualquer fuso
+    return dt.replace(tzinfo=timezone.utc).astimezone(tz).replace(tzinfo=None)
+
+def _event_days(e, tz):
+    """Datas locais ocupadas pelo evento (eventos de vários dias aparecem em cada um)"""
+    first = _local_datetime(e, 'start', tz)
+    last = first
+    if e.get('end'):
+        # 'end' é exclusivo: evento até 00:00 não ocupa o dia seguinte
+        last = max(first, _local_datetime(e, 'end', tz) - timedelta(microseconds=1))
+    
+    day = first.date()
+    while day <= last.date():
+        yield day
+        day += timedelta(days=1)
+
+def _minimal_event(e):
+    """Só os campos usados pelo índice e pelos dispositivos"""
+    return {field: e[field] for field in ('subject', 'start', 'end', 'isAllDay') if field in e}
+
+def _format_event(e, tz, day=None):
+    """Converte um evento do Graph no formato enviado aos dispositivos, como exibido em 'day'"""
+    sd = _local_datetime(e, 'start', tz)
+    # Dias seguintes de um evento de vários dias aparecem como dia inteiro
+    timed = not e.get('isAllDay') and (day is None or day == sd.date())
+    return {
+        'title': e.get('subject', 'Sem título'),
+        'time': sd.strftime('%H:%M') if timed else '',
+        'isAllDay': not timed
+    }
+
+def fetch_events(auth_mode, user_email, start, end, token=None, first_page=None):
+    """Busca eventos no Graph; retorna None em caso de erro"""
+    token = token or get_valid_token()
+    if not token:
+        print("❌ Token não disponível para buscar eventos")
+        return None
     
-    today = datetime.now().date()
-    start = datetime.combine(today, datetime.min.time()).isoformat() + 'Z'
-    end = datetime.combine(today, datetime.max.time()).isoformat() + 'Z'
+    if CALENDAR_DELTA_SYNC:
+        return fetch_events_delta(token, auth_mode, user_email, start, end, first_page)
     
-    # Determina o endpoint correto
+    try:
+        # Um evento a mais (no máximo uma página extra) só para detectar o corte
+        events = list(islice(iter_events(token, auth_mode, user_email, start, end, first_page),
+                             EVENTS_FETCH_LIMIT + 1))
+        if len(events) > EVENTS_FETCH_LIMIT:
+            events = events[:EVENTS_FETCH_LIMIT]
+            # Ordenados por início: os dias depois do último evento ficam incompletos
+            print(f"⚠️ Mais de {EVENTS_FETCH_LIMIT} eventos em {start} - {end}: janela cortada "
+                  f"após {events[-1]['start']['dateTime'][:16]} (EVENTS_FETCH_LIMIT)")
+        print(f"✅ {len(events)} eventos obtidos")
+        return events
+    except GraphUnavailable as e:
+        print(f"⏸️ Graph indisponível ({e.message}) - usando últimos eventos conhecidos")
+        return None
+    except GraphError as e:
+        print(f"❌ Erro ao buscar eventos: {e.status}")
+        if e.message:
+            print(f"   Detalhes: {e.message}")
+        return None
+    except Exception as e:
+        print(f"❌ Erro na requisição de eventos: {e}")
+        return None
+
+def _events_request(auth_mode, user_email, start, end):
+    """URL e parâmetros da consulta completa (calendarView expande recorrências)"""
     if auth_mode == 'application' and user_email:
         # Application mode - precisa especificar o usuário
-        url = f"{GRAPH_ENDPOINT}users/{user_email}/events"
-        print(f"🔍 Buscando eventos (Application) para: {user_email}")
+        url = f"users/{user_email}/calendarView"
     else:
         # Delegated mode - usa /me
-        url = f"{GRAPH_ENDPOINT}me/events"
-        print("🔍 Buscando eventos (Delegated) para usuário autenticado")
+        url = "me/calendarView"
     
     params = {
-        '$filter': f"start/dateTime ge '{start}' and start/dateTime le '{end}'",
+        'startDateTime': start,
+        'endDateTime': end,
         '$select': 'subject,start,end,location,isAllDay',
         '$orderby': 'start/dateTime asc',
-        '$top': 20
+        '$top': GRAPH_PAGE_SIZE
     }
+    return url, params
+
+def _continue_pages(first_page, token, headers=None):
+    """Primeira página já recebida (ex.: via $batch) seguida das demais sob demanda"""
+    yield first_page
+    if first_page.get('@odata.nextLink'):
+        yield from graph.iter_pages(first_page['@odata.nextLink'], token, headers=headers)
+
+def iter_events(token, auth_mode, user_email, start, end, first_page=None):
+    """Gera os eventos da janela em ordem, buscando páginas só quando consumidas"""
+    if auth_mode == 'application' and user_email:
+        print(f"🔍 Buscando eventos (Application) para: {user_email}")
+    else:
+        print("🔍 Buscando eventos (Delegated) para usuário autenticado")
+    
+    if first_page is not None:
+        pages = _continue_pages(first_page, token)
+    else:
+        url, params = _events_request(auth_mode, user_email, start, end)
+        pages = graph.iter_pages(url, token, params=params)
+    
+    for page in pages:
+        for e in page.get('value', []):
+            yield _minimal_event(e)
+
+def _load_delta_state(sync_key):
+    with get_db() as conn:
+        row = conn.execute('SELECT delta_link, events FROM calendar_delta WHERE sync_key = ?',
+                           (sync_key,)).fetchone()
+    if not row:
+        return None, {}
+    return row['delta_link'], json.loads(row['events'] or '{}')
+
+def _save_delta_state(sync_key, delta_link, event_set):
+    with get_db() as conn:
+        conn.execute('''INSERT OR REPLACE INTO calendar_delta (sync_key, delta_link, events, updated_at)
+                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)''',
+                    (sync_key, delta_link, json.dumps(event_set, ensure_ascii=False)))
+        # Janelas antigas não serão mais consultadas
+        conn.execute("DELETE FROM calendar_delta WHERE updated_at < datetime('now', ?)",
+                     (f'-{EVENTS_PREFETCH_DAYS + 1} days',))
+
+def _apply_delta_pages(pages, event_set):
+    """Aplica as páginas do delta ao conjunto local; retorna (delta_link, alterações)"""
+    changes = 0
+    delta_link = None
+    for page in pages:
+        for item in page.get('value', []):
+            changes += 1
+            if '@removed' in item:
+                event_set.pop(item['id'], None)
+            else:
+                current = event_set.get(item['id'], {})
+                for field in ('subject', 'start', 'end', 'isAllDay'):
+                    if field in item:
+                        current[field] = item[field]
+                event_set[item['id']] = current
+        delta_link = page.get('@odata.deltaLink', delta_link)
+    return delta_link, changes
+
+DELTA_HEADERS = {'Prefer': f'odata.maxpagesize={GRAPH_PAGE_SIZE}'}
+
+def _delta_request(auth_mode, user_email, start, end):
+    """Próxima requisição delta da caixa: (base, url, params, delta_link, event_set)"""
+    if auth_mode == 'application' and user_email:
+        base = f"users/{user_email}"
+    else:
+        base = "me"
+    
+    delta_link, event_set = _load_delta_state(f"{user_email or 'me'}|{start}|{end}")
+    if delta_link:
+        return base, delta_link, None, delta_link, event_set
+    return (base, f"{base}/calendarView/delta", {'startDateTime': start, 'endDateTime': end},
+            None, event_set)
+
+def fetch_events_delta(token, auth_mode, user_email, start, end, first_page=None):
+    """Sincronização incremental: aplica só as mudanças desde o último delta link"""
+    sync_key = f"{user_email or 'me'}|{start}|{end}"
+    base, url, params, delta_link, event_set = _delta_request(auth_mode, user_email, start, end)
+    
+    if delta_link:
+        print(f"🔍 Sincronização incremental de eventos: {user_email or 'me'}")
+    else:
+        print(f"🔍 Sincronização inicial (delta) de eventos: {user_email or 'me'}")
+    
+    headers = DELTA_HEADERS
     
     try:
-        res = requests.get(url, headers={'Authorization': f'Bearer {token}'}, params=params, timeout=10)
-        
-        if res.status_code == 200:
-            events = []
-            for e in res.json().get('value', []):
-                sd = datetime.fromisoformat(e['start']['dateTime'].replace('Z', '+00:00'))
-                events.append({
-                    'title': e.get('subject', 'Sem título'),
-                    'time': sd.strftime('%H:%M') if not e.get('isAllDay') else '',
-                    'isAllDay': e.get('isAllDay', False)
-                })
-            print(f"✅ {len(events)} eventos obtidos")
-            return events
-        else:
-            print(f"❌ Erro ao buscar eventos: {res.status_code}")
-            try:
-                error_data = res.json()
-                print(f"   Detalhes: {error_data.get('error', {}).get('message', 'Sem detalhes')}")
-            except:
-                pass
-            return []
+        try:
+            if first_page is not None:
+                pages = _continue_pages(first_page, token, headers)
+            else:
+                pages = graph.iter_pages(url, token, params=params, headers=headers)
+            delta_link, changes = _apply_delta_pages(pages, event_set)
+        except GraphError as e:
+            # 410 = estado de sincronização expirou no Graph; recomeça do zero
+            if e.status != 410 or not delta_link:
+                raise
+            print("⚠️ Delta link expirado - refazendo sincronização inicial")
+            event_set = {}
+            delta_link, changes = _apply_delta_pages(
+                graph.iter_pages(f"{base}/calendarView/delta", token,
+                                 params={'startDateTime': start, 'endDateTime': end},
+                                 headers=headers),
+                event_set)
+    except GraphUnavailable as e:
+        print(f"⏸️ Graph indisponível ({e.message}) - usando últimos eventos conhecidos")
+        return None
+    except GraphError as e:
+        print(f"❌ Erro na sincronização delta: {e.status}")
+        return None
     except Exception as e:
-        print(f"❌ Erro na requisição de eventos: {e}")
-        return []
+        print(f"❌ Erro na sincronização delta: {e}")
+        return None
+    
+    _save_delta_state(sync_key, delta_link, event_set)
+    
+    events = sorted((e for e in event_set.values() if 'start' in e),
+                    key=lambda e: e['start']['dateTime'])
+    print(f"✅ {len(events)} eventos ({changes} alteração(ões) aplicada(s))")
+    return events
+
+def fetch_events_batch(token, queries):
+    """Busca várias (caixa, início, fim) no modo application com até 20 requisições por $batch"""
+    results = {}
+    
+    for i in range(0, len(queries), GRAPH_BATCH_SIZE):
+        chunk = queries[i:i + GRAPH_BATCH_SIZE]
+        batch_requests = []
+        
+        for n, (mailbox, start, end) in enumerate(chunk):
+            if CALENDAR_DELTA_SYNC:
+                _, url, params, _, _ = _delta_request('application', mailbox, start, end)
+                headers = DELTA_HEADERS
+            else:
+                url, params = _events_request('application', mailbox, start, end)
+                headers = {}
+            batch_requests.append({
+                'id': str(n),
+                'method': 'GET',
+                'url': graph.relative(url, params),
+                'headers': headers
+            })
+        
+        print(f"📦 $batch: {len(chunk)} janela(s) em uma requisição")
+        try:
+            responses = graph.batch(token, batch_requests)
+        except GraphError as e:
+            print(f"❌ Erro no $batch: {e}")
+            continue
+        except Exception as e:
+            print(f"❌ Erro no $batch: {e}")
+            continue
+        
+        # Demultiplexa: cada resposta alimenta o mesmo fluxo da busca individual
+        for n, query in enumerate(chunk):
+            mailbox, start, end = query
+            sub = responses.get(str(n))
+            if not sub or sub.get('status') in (429, 503):
+                results[query] = None
+            elif sub.get('status') == 200:
+                results[query] = fetch_events('application', mailbox, start, end,
+                                              token=token, first_page=sub.get('body') or {})
+            else:
+                # Outros erros (ex.: 410 do delta) seguem pelo caminho individual
+                results[query] = fetch_events('application', mailbox, start, end, token=token)
+    
+    return results
 
 # ============================================================================
 # MQTT MANAGER
 # ============================================================================
 
+class PayloadCache:
+    """Payloads já codificados por (versão, data, formato), compartilhados entre dispositivos"""
+    
+    def __init__(self, max_entries=PAYLOAD_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+    
+    def get(self, key, build):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        
+        payload = build()
+        with self._lock:
+            self._entries[key] = payload
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+payload_cache = PayloadCache()
+
+def encode_events_json(day, events, version):
+    """Payload JSON enviado aos dispositivos; sync_time é o momento da codificação"""
+    events = events[:DEVICE_MAX_EVENTS]
+    return json.dumps({
+        'version': version,
+        'date': day.isoformat(),
+        'events': events,
+        'count': len(events),
+        'sync_time': datetime.now().isoformat()
+    }, ensure_ascii=False).encode('utf-8')
+
+# Binário mmb1 (big-endian):
+#   cabeçalho: 'MM', formato (1), ano u16, mês u8, dia u8, nº de eventos u8,
+#              versão (u8 tamanho + ASCII)
+#   evento:    flags u8 (bit 0 = dia inteiro), minuto do dia u16, título (u8 tamanho + UTF-8)
+EVENTS_BIN_MAGIC = b'MM'
+EVENTS_BIN_HEADER = struct.Struct('>2sBHBBBB')
+EVENTS_BIN_EVENT = struct.Struct('>BHB')
+EVENTS_BIN_ALL_DAY = 0x01
+
+def _bin_string(text):
+    """u8 tamanho + UTF-8, truncado sem partir caracteres"""
+    data = text.encode('utf-8')[:255].decode('utf-8', 'ignore').encode('utf-8')
+    return bytes([len(data)]) + data
+
+def encode_events_binary(day, events, version):
+    """Payload mmb1: sem chaves nem datas ISO, decodificável sem json no firmware"""
+    events = events[:min(DEVICE_MAX_EVENTS, 255)]
+    version = version.encode('ascii')
+    parts = [EVENTS_BIN_HEADER.pack(EVENTS_BIN_MAGIC, 1, day.year, day.month, day.day,
+                                    len(events), len(version)), version]
+    for e in events:
+        all_day = e.get('isAllDay') or not e.get('time')
+        hour, minute = (0, 0) if all_day else map(int, e['time'].split(':'))
+        title = _bin_string(e.get('title') or '')
+        parts.append(EVENTS_BIN_EVENT.pack(EVENTS_BIN_ALL_DAY if all_day else 0,
+                                           hour * 60 + minute, title[0]))
+        parts.append(title[1:])
+    return b''.join(parts)
+
+PAYLOAD_ENCODERS = {
+    'json': encode_events_json,
+    'mmb1': encode_events_binary
+}
+
+def negotiate_format(formats):
+    """Primeiro formato do servidor que o firmware declarou suportar"""
+    if isinstance(formats, list):
+        for fmt in PAYLOAD_FORMATS:
+            if fmt in formats:
+                return fmt
+    return 'json'
+
+def device_group_id(mailbox, tz, fmt=None):
+    """Grupo dos dispositivos que exibem a mesma caixa no mesmo fuso e formato"""
+    key = f"{mailbox or ''}|{tz or ''}"
+    if fmt and fmt != 'json':
+        key += f"|{fmt}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+# registration_ids aprovados: presença e acks chegam por tópicos públicos do broker,
+# ids fora deste conjunto são ignorados (atualizado por approved_groups e pelos registros)
+approved_devices = {'ids': frozenset()}
+
+def approved_groups():
+    """{group_id: {'mailbox', 'timezone', 'format', 'devices', 'registrations'}} dos aprovados"""
+    with get_db() as conn:
+        devs = conn.execute('''SELECT registration_id, device_id, mailbox, timezone, payload_format
+                               FROM devices WHERE status = "approved"''').fetchall()
+    
+    groups = {}
+    for d in devs:
+        fmt = d['payload_format'] or 'json'
+        group = groups.setdefault(device_group_id(d['mailbox'], d['timezone'], fmt),
+                                  {'mailbox': d['mailbox'], 'timezone': d['timezone'], 'format': fmt,
+                                   'devices': [], 'registrations': []})
+        group['devices'].append(d['device_id'])
+        group['registrations'].append(d['registration_id'])
+    approved_devices['ids'] = frozenset(d['registration_id'] for d in devs)
+    return groups
+
+class PresenceTracker:
+    """Tabela em memória de dispositivos online/offline, por registration_id"""
+    
+    def __init__(self, timeout=PRESENCE_TIMEOUT):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._state = {}  # registration_id -> {'online', 'since', 'seen'}
+    
+    def _online(self, entry, now):
+        return entry['online'] and now - entry['seen'] < self.timeout
+    
+    def update(self, reg_id, online):
+        """Registra um sinal; True se o dispositivo acabou de voltar (offline -> online)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._state.get(reg_id)
+            was_online = self._online(entry, now) if entry else None
+            if was_online is None or was_online != online:
+                self._state[reg_id] = {'online': online, 'since': datetime.now(), 'seen': now}
+            else:
+                entry['seen'] = now
+        return online and was_online is False
+    
+    def status(self, reg_id):
+        """True/False, ou None se nunca deu sinal (firmware sem presença)"""
+        with self._lock:
+            entry = self._state.get(reg_id)
+            return self._online(entry, time.monotonic()) if entry else None
+    
+    def since(self, reg_id):
+        with self._lock:
+            entry = self._state.get(reg_id)
+            return entry['since'].isoformat() if entry else None
+    
+    def counts(self, reg_ids):
+        """Online/offline entre os dispositivos dados (quem nunca deu sinal não conta)"""
+        statuses = [self.status(r) for r in reg_ids]
+        return {'online': statuses.count(True), 'offline': statuses.count(False)}
+    
+    def any_listening(self, reg_ids):
+        """Algum dispositivo do grupo pode receber (online ou sem presença conhecida)"""
+        return any(self.status(r) is not False for r in reg_ids)
+
+presence = PresenceTracker()
+
+def percentiles(values, points=(50, 90, 99)):
+    """Percentis (nearest-rank) de uma lista de latências, em ms"""
+    if not values:
+        return {f'p{p}': None for p in points}
+    ordered = sorted(values)
+    return {f'p{p}': round(ordered[max(0, -(-p * len(ordered) // 100) - 1)] * 1000)
+            for p in points}
+
+class DeliveryTracker:
+    """Latência publish -> ack por dispositivo e quem ainda não confirmou a última versão"""
+    
+    def __init__(self, history=ACK_HISTORY):
+        self.history = history
+        self._lock = threading.Lock()
+        self._sent = {}     # group_id -> {'version', 'sent', 'at'}
+        self._devices = {}  # registration_id -> {'version', 'sent', 'at', 'latency', 'samples'}
+    
+    def sent(self, group_id, version):
+        with self._lock:
+            self._sent[group_id] = {'version': version, 'sent': time.monotonic(), 'at': datetime.now()}
+    
+    def ack(self, reg_id, group_id, version):
+        """Registra o ack; devolve a latência (s) ou None se não corresponde a uma publicação nova"""
+        now = time.monotonic()
+        with self._lock:
+            dev = self._devices.setdefault(reg_id, {'version': None, 'sent': None, 'at': None,
+                                                    'latency': None,
+                                                    'samples': deque(maxlen=self.history)})
+            dev['version'], dev['at'] = version, datetime.now()
+            
+            pub = self._sent.get(group_id)
+            # Mensagem retida reentregue na reconexão: já confirmada, não conta de novo
+            if not pub or pub['version'] != version or dev['sent'] == pub['sent']:
+                return None
+            dev['sent'] = pub['sent']
+            dev['latency'] = now - pub['sent']
+            dev['samples'].append(dev['latency'])
+            return dev['latency']
+    
+    def device(self, reg_id):
+        with self._lock:
+            dev = self._devices.get(reg_id)
+            if not dev:
+                return {'acked_version': None, 'acked_at': None, 'last_latency_ms': None,
+                        **percentiles([])}
+            return {'acked_version': dev['version'],
+                    'acked_at': dev['at'].isoformat(),
+                    'last_latency_ms': round(dev['latency'] * 1000) if dev['latency'] is not None else None,
+                    **percentiles(list(dev['samples']))}
+    
+    def pending(self, reg_id, group_id):
+        """Desde quando (datetime) a última publicação do grupo espera o ack; None se confirmada"""
+        with self._lock:
+            pub = self._sent.get(group_id)
+            dev = self._devices.get(reg_id)
+            if not pub or time.monotonic() - pub['sent'] < ACK_TIMEOUT:
+                return None
+            if dev and dev['sent'] == pub['sent']:
+                return None
+            return pub['at']
+    
+    def summary(self, reg_ids):
+        """Percentis agregados dos dispositivos dados"""
+        with self._lock:
+            samples = [lat for r in reg_ids if r in self._devices for lat in self._devices[r]['samples']]
+        return {'samples': len(samples), **percentiles(samples)}
+
+delivery = DeliveryTracker()
+
 class MQTTManager:
     def __init__(self):
         self.connected = False
@@ -338,6 +1555,23 @@ class MQTTManager:
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
         self.topic_prefix = TOPIC_PREFIX
+        # Toda publicação passa pelos dois baldes (mensagens/s e bytes/s)
+        self.messages_bucket = TokenBucket(MQTT_PUBLISH_RATE, MQTT_PUBLISH_BURST)
+        self.bytes_bucket = TokenBucket(MQTT_BYTES_RATE, MQTT_BYTES_BURST)
+        # Chave do payload publicado por tópico: só publica quando muda
+        self._published = {}
+        self._published_lock = threading.Lock()
+        # Uma sincronização por grupo por vez; pedidos simultâneos aguardam a mesma
+        self._sync_flight = SingleFlight()
+        # Registros: a thread de rede só filtra e enfileira; workers fazem o resto
+        self._registrations = queue.Queue(maxsize=REGISTRATION_QUEUE_SIZE)
+        self._recent_registrations = {}  # registration_id -> último aceito (monotonic)
+        self._recent_lock = threading.Lock()
+    
+    def start(self):
+        """Workers de registro + conexão; só depois de o agendador e os executores existirem"""
+        for _ in range(REGISTRATION_WORKERS):
+            threading.Thread(target=self._registration_worker, daemon=True).start()
         self.connect()
     
     def connect(self):
@@ -352,6 +1586,11 @@ class MQTTManager:
             self.connected = True
             topic = f"{self.topic_prefix}/registration"
             client.subscribe(topic)
+            client.subscribe(f"{self.topic_prefix}/presence/+")
+            client.subscribe(f"{self.topic_prefix}/ack/+")
+            # O broker pode ter perdido as mensagens retidas: republica tudo
+            with self._published_lock:
+                self._published.clear()
             print(f"✅ MQTT conectado - Tópico: {topic}\n")
     
     def on_disconnect(self, client, userdata, rc):
@@ -359,90 +1598,232 @@ class MQTTManager:
         print("🔌 MQTT desconectado")
     
     def on_message(self, client, userdata, msg):
+        """Roda na thread de rede do paho: nada de banco nem threads novas aqui"""
         try:
-            payload = json.loads(msg.payload.decode())
-            
-            if 'registration' in msg.topic and payload.get('status') == 'requesting_approval':
-                reg_id = payload.get('registration_id')
-                if reg_id and not payload.get('device_id'):
-                    print(f"\n📨 Novo dispositivo solicitando registro: {reg_id}")
-                    self.handle_registration(payload)
+            if msg.topic == f"{self.topic_prefix}/registration":
+                self._accept_registration(msg.payload)
+            elif msg.topic.startswith(f"{self.topic_prefix}/presence/"):
+                self._handle_presence(msg.topic.rsplit('/', 1)[1], msg.payload)
+            elif msg.topic.startswith(f"{self.topic_prefix}/ack/"):
+                self._handle_ack(msg.topic.rsplit('/', 1)[1], msg.payload)
         except Exception as e:
             print(f"❌ Erro ao processar mensagem MQTT: {e}")
     
+    def _accept_registration(self, raw):
+        # Pré-filtro nos bytes: descarta nossas próprias respostas e lixo sem decodificar
+        if len(raw) > REGISTRATION_MAX_BYTES or b'requesting_approval' not in raw:
+            return
+        
+        payload = json.loads(raw)
+        if not isinstance(payload, dict) or payload.get('status') != 'requesting_approval':
+            return
+        reg_id = payload.get('registration_id')
+        if not reg_id or payload.get('device_id') or not self._first_in_window(reg_id):
+            return
+        
+        try:
+            self._registrations.put_nowait(payload)
+        except queue.Full:
+            # O firmware reenvia em 60s; libera o id para essa nova tentativa
+            with self._recent_lock:
+                self._recent_registrations.pop(reg_id, None)
+            print(f"⚠️ Fila de registros cheia - {reg_id} descartado")
+    
+    def _first_in_window(self, reg_id):
+        """False se o mesmo registration_id já foi aceito há menos de REGISTRATION_DEDUP_WINDOW"""
+        now = time.monotonic()
+        with self._recent_lock:
+            last = self._recent_registrations.get(reg_id)
+            if last is not None and now - last < REGISTRATION_DEDUP_WINDOW:
+                return False
+            self._recent_registrations[reg_id] = now
+            
+            if len(self._recent_registrations) > REGISTRATION_QUEUE_SIZE * 4:
+                for key, seen in list(self._recent_registrations.items()):
+                    if now - seen >= REGISTRATION_DEDUP_WINDOW:
+                        del self._recent_registrations[key]
+            return True
+    
+    def _handle_presence(self, reg_id, raw):
+        if reg_id not in approved_devices['ids']:
+            return
+        if raw == b'offline':
+            if presence.status(reg_id) is not False:
+                print(f"🔴 {reg_id} offline")
+            presence.update(reg_id, False)
+        elif raw in (b'online', b'hb'):
+            if presence.update(reg_id, True):
+                # Voltou: as sincronizações puladas enquanto esteve fora são refeitas
+                print(f"🟢 {reg_id} voltou - sincronizando")
+                sync_executor.submit(self._catch_up, reg_id)
+    
+    def _handle_ack(self, reg_id, raw):
+        if reg_id not in approved_devices['ids'] or len(raw) > REGISTRATION_MAX_BYTES:
+            return
+        ack = json.loads(raw)
+        latency = delivery.ack(reg_id, ack.get('group_id'), ack.get('version'))
+        if latency is not None:
+            print(f"📬 {reg_id} confirmou {ack.get('version')} em {latency * 1000:.0f}ms")
+    
+    def _catch_up(self, reg_id):
+        with get_db() as conn:
+            conn.execute('UPDATE devices SET last_seen = CURRENT_TIMESTAMP WHERE registration_id = ?', (reg_id,))
+            dev = conn.execute('''SELECT mailbox, timezone, payload_format, status
+                                  FROM devices WHERE registration_id = ?''', (reg_id,)).fetchone()
+        if dev and dev['status'] == 'approved':
+            sync_scheduler.trigger(device_group_id(dev['mailbox'], dev['timezone'], dev['payload_format']))
+    
+    def _registration_worker(self):
+        while True:
+            payload = self._registrations.get()
+            print(f"\n📨 Novo dispositivo solicitando registro: {payload['registration_id']}")
+            try:
+                self.handle_registration(payload)
+            except Exception as e:
+                print(f"❌ Erro ao processar registro: {e}")
+    
+    def publish(self, topic, payload, **kwargs):
+        """Publica respeitando o orçamento de mensagens e bytes por segundo"""
+        size = len(payload.encode('utf-8')) if isinstance(payload, str) else len(payload)
+        self.messages_bucket.acquire()
+        self.bytes_bucket.acquire(size)
+        return self.client.publish(topic, payload, **kwargs)
+    
     def handle_registration(self, payload):
         reg_id = payload.get('registration_id')
         info = payload.get('device_info', 'Dispositivo Desconhecido')
         mac = payload.get('mac_address', '')
+        tz = timezone_key(payload.get('timezone', payload.get('timezone_offset')))
+        fmt = negotiate_format(payload.get('formats'))
         
         if not reg_id:
             return
         
-        conn = get_db()
-        
         try:
-            dev = conn.execute('SELECT * FROM devices WHERE registration_id = ?', (reg_id,)).fetchone()
-            
-            if dev and dev['status'] == 'approved' and dev['device_id']:
-                device_id = dev['device_id']
-                conn.execute('UPDATE devices SET last_seen = CURRENT_TIMESTAMP WHERE registration_id = ?', (reg_id,))
-                conn.commit()
-                print(f"✅ Dispositivo já aprovado: {device_id}")
-            else:
-                device_id = f"mirror_{secrets.token_urlsafe(6)}"
+            with get_db() as conn:
+                dev = conn.execute('SELECT * FROM devices WHERE registration_id = ?', (reg_id,)).fetchone()
                 
-                if dev:
-                    conn.execute('''UPDATE devices SET device_id = ?, status = 'approved', 
-                                    last_seen = CURRENT_TIMESTAMP WHERE registration_id = ?''', 
-                                (device_id, reg_id))
+                if dev and dev['status'] == 'approved' and dev['device_id']:
+                    device_id = dev['device_id']
+                    conn.execute('UPDATE devices SET last_seen = CURRENT_TIMESTAMP WHERE registration_id = ?', (reg_id,))
+                    print(f"✅ Dispositivo já aprovado: {device_id}")
                 else:
-                    conn.execute('''INSERT INTO devices (registration_id, device_id, device_info, 
-                                    mac_address, status) VALUES (?, ?, ?, ?, 'approved')''', 
-                                (reg_id, device_id, info, mac))
+                    device_id = f"mirror_{secrets.token_urlsafe(6)}"
+                    
+                    if dev:
+                        conn.execute('''UPDATE devices SET device_id = ?, status = 'approved', 
+                                        last_seen = CURRENT_TIMESTAMP WHERE registration_id = ?''', 
+                                    (device_id, reg_id))
+                    else:
+                        conn.execute('''INSERT INTO devices (registration_id, device_id, device_info, 
+                                        mac_address, status) VALUES (?, ?, ?, ?, 'approved')''', 
+                                    (reg_id, device_id, info, mac))
+                    
+                    print(f"✅ Novo dispositivo aprovado: {device_id}")
+                    subscription_wakeup.set()
                 
-                conn.commit()
-                print(f"✅ Novo dispositivo aprovado: {device_id}")
-            
-            resp = {
-                'registration_id': reg_id,
-                'status': 'approved',
-                'device_id': device_id,
-                'topic_prefix': self.topic_prefix,
-                'events_topic': f"{self.topic_prefix}/devices/{device_id}/events"
-            }
+                # O firmware informa o próprio fuso a cada registro (offset fixo):
+                # não sobrescreve um fuso definido pelo admin
+                if tz:
+                    conn.execute('''UPDATE devices SET timezone = ? WHERE registration_id = ?
+                                    AND timezone_source IS NULL''', (tz, reg_id))
+                # ...e os formatos que decodifica (firmware atualizado pode mudar de grupo)
+                conn.execute('UPDATE devices SET payload_format = ? WHERE registration_id = ?', (fmt, reg_id))
+                
+                dev = conn.execute('SELECT * FROM devices WHERE registration_id = ?', (reg_id,)).fetchone()
             
-            self.client.publish(f"{self.topic_prefix}/registration", json.dumps(resp))
-            threading.Thread(target=lambda: time.sleep(2) or self.sync_device(device_id), daemon=True).start()
+            approved_devices['ids'] |= {reg_id}
+            resp = self._registration_response(dev)
+            self.publish(f"{self.topic_prefix}/registration", json.dumps(resp))
+            # Fura a fila do agendador (pedidos repetidos não duplicam o sync)
+            sync_scheduler.trigger(resp['group_id'])
             
         except Exception as e:
             print(f"❌ Erro ao processar registro: {e}")
-        finally:
-            conn.close()
     
-    def sync_device(self, device_id):
+    def group_topic(self, group_id):
+        return f"{self.topic_prefix}/groups/{group_id}/events"
+    
+    def _registration_response(self, dev):
+        fmt = dev['payload_format'] or 'json'
+        group_id = device_group_id(dev['mailbox'], dev['timezone'], fmt)
+        return {
+            'registration_id': dev['registration_id'],
+            'status': 'approved',
+            'device_id': dev['device_id'],
+            'topic_prefix': self.topic_prefix,
+            'group_id': group_id,
+            'format': fmt,
+            'events_topic': self.group_topic(group_id)
+        }
+    
+    def announce_device(self, device_id):
+        """Reenvia o registro (novo tópico de grupo) após mudar caixa ou fuso"""
+        with get_db() as conn:
+            dev = conn.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+        if not dev or not self.connected:
+            return
+        
+        resp = self._registration_response(dev)
+        self.publish(f"{self.topic_prefix}/registration", json.dumps(resp))
+        print(f"📢 {device_id} -> grupo {resp['group_id']}")
+        sync_scheduler.trigger(resp['group_id'])
+    
+    def sync_device(self, device_id, force=False):
+        """Sincroniza o grupo do dispositivo"""
+        with get_db() as conn:
+            dev = conn.execute('SELECT mailbox, timezone, payload_format FROM devices WHERE device_id = ?',
+                               (device_id,)).fetchone()
+        
+        if not dev:
+            print(f"❌ Dispositivo não encontrado: {device_id}")
+            return False
+        return self.sync_group(dev['mailbox'], dev['timezone'], dev['payload_format'] or 'json', force)
+    
+    def sync_in_flight(self, group_id):
+        return self._sync_flight.in_flight(group_id)
+    
+    def sync_group(self, mailbox, tz, fmt='json', force=False):
+        """Sincroniza o grupo; se já houver uma sincronização dele em andamento, aguarda a mesma"""
+        group_id = device_group_id(mailbox, tz, fmt)
+        # Com force não reaproveita: a sincronização em andamento pode ter pulado a publicação
+        return self._sync_flight.do(group_id, lambda: self._sync_group(group_id, mailbox, tz, fmt, force),
+                                    join=not force)
+    
+    def _sync_group(self, group_id, mailbox, tz, fmt, force):
+        """Publica os eventos no tópico do grupo (retido); pula se nada mudou, salvo 'force'"""
         if not self.connected:
             print("❌ MQTT não conectado - sync abortado")
             return False
         
-        print(f"🔄 Iniciando sincronização: {device_id}")
+        print(f"🔄 Iniciando sincronização do grupo: {group_id}")
         
-        events = get_today_events()
-        events_sorted = sorted(events, key=lambda x: x.get('time', '23:59'))
+        today = local_today(tz)
         
-        data = {
-            'device_id': device_id,
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'events': events_sorted,
-            'count': len(events_sorted),
-            'sync_time': datetime.now().isoformat()
-        }
+        # Mesma versão + data = mesmos bytes: codifica uma vez para todos os grupos
+        # Publicação é o que o espelho exibe até a próxima: nada de índice vencido
+        version, events = get_day_snapshot(today, mailbox=mailbox, tz=tz, fresh=True)
+        key = (version, today.isoformat(), fmt)
+        msg = payload_cache.get(key, lambda: PAYLOAD_ENCODERS[fmt](today, events, version))
         
-        topic = f"{self.topic_prefix}/devices/{device_id}/events"
-        msg = json.dumps(data, ensure_ascii=False)
+        # Um publish por grupo: o broker entrega a cada dispositivo inscrito
+        topic = self.group_topic(group_id)
+        with self._published_lock:
+            unchanged = self._published.get(topic) == key
+        if unchanged and not force:
+            print(f"⏭️ Sem mudanças para o grupo {group_id} - publicação pulada\n")
+            return True
         
         try:
-            self.client.publish(topic, msg)
-            print(f"✅ Sincronização concluída: {len(events_sorted)} eventos enviados\n")
+            # Retida: quem reconecta recebe o estado atual direto do broker
+            info = self.publish(topic, msg, retain=True)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                print(f"❌ Erro na sincronização: publish rc={info.rc}")
+                return False
+            with self._published_lock:
+                self._published[topic] = key
+            delivery.sent(group_id, version)
+            print(f"✅ Sincronização concluída: {min(len(events), DEVICE_MAX_EVENTS)} eventos enviados\n")
             return True
         except Exception as e:
             print(f"❌ Erro na sincronização: {e}")
@@ -450,6 +1831,281 @@ class MQTTManager:
 
 mqtt_manager = MQTTManager()
 
+# ============================================================================
+# NOTIFICAÇÕES DE ALTERAÇÃO (WEBHOOK DO GRAPH)
+# ============================================================================
+
+# Acordado quando as caixas em uso ou a autenticação mudam
+subscription_wakeup = threading.Event()
+subscription_state = {'healthy': False}
+
+_notify_lock = threading.Lock()
+_notify_pending = set()
+_notify_event = threading.Event()
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _subscription_resource(auth_mode, mailbox):
+    if auth_mode == 'application' and mailbox:
+        return f"users/{mailbox}/events"
+    return "me/events"
+
+def _wanted_subscriptions():
+    """{caixa: recurso} para as caixas exibidas pelos dispositivos aprovados"""
+    with get_db() as conn:
+        devs = conn.execute('SELECT mailbox FROM devices WHERE status = "approved"').fetchall()
+    
+    wanted = {}
+    for d in devs:
+        auth_mode, mailbox = resolve_mailbox(d['mailbox'])
+        wanted[mailbox or 'me'] = _subscription_resource(auth_mode, mailbox)
+    return wanted
+
+def _save_subscription(mailbox, sub, resource, client_state):
+    # O Graph pode conceder uma validade menor que a pedida
+    expires_at = datetime.fromisoformat(sub['expirationDateTime'][:19]).isoformat()
+    with get_db() as conn:
+        conn.execute('''INSERT OR REPLACE INTO subscriptions
+                        (mailbox, subscription_id, resource, client_state, expires_at)
+                        VALUES (?, ?, ?, ?, ?)''',
+                     (mailbox, sub['id'], resource, client_state, expires_at))
+
+def _expiration():
+    return (_utcnow() + timedelta(seconds=SUBSCRIPTION_LIFETIME)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _create_subscription(token, mailbox, resource):
+    client_state = secrets.token_urlsafe(24)
+    res = graph.post('subscriptions', token, {
+        'changeType': 'created,updated,deleted',
+        'notificationUrl': NOTIFICATION_URL,
+        'lifecycleNotificationUrl': NOTIFICATION_URL,
+        'resource': resource,
+        'expirationDateTime': _expiration(),
+        'clientState': client_state
+    })
+    if res.status_code != 201:
+        raise GraphError.from_response(res)
+    
+    _save_subscription(mailbox, res.json(), resource, client_state)
+    print(f"🔔 Assinatura criada: {resource}")
+
+def _renew_subscription(token, row):
+    """Estende a validade; False se o Graph não conhece mais a assinatura"""
+    res = graph.patch(f"subscriptions/{row['subscription_id']}", token,
+                      {'expirationDateTime': _expiration()})
+    if res.status_code == 404:
+        return False
+    if res.status_code != 200:
+        raise GraphError.from_response(res)
+    
+    _save_subscription(row['mailbox'], res.json(), row['resource'], row['client_state'])
+    print(f"🔁 Assinatura renovada: {row['resource']}")
+    return True
+
+def _delete_subscription(token, row):
+    try:
+        graph.delete(f"subscriptions/{row['subscription_id']}", token)
+    except (GraphError, requests.RequestException):
+        pass  # expira sozinha; notificações de ids desconhecidos são ignoradas
+    with get_db() as conn:
+        conn.execute('DELETE FROM subscriptions WHERE mailbox = ?', (row['mailbox'],))
+    print(f"🔕 Assinatura removida: {row['resource']}")
+
+def clear_subscriptions():
+    """Esquece as assinaturas (credenciais mudaram); o gerenciador recria"""
+    with get_db() as conn:
+        conn.execute('DELETE FROM subscriptions')
+    subscription_state['healthy'] = False
+    subscription_wakeup.set()
+
+def sync_subscriptions():
+    """Cria, renova e remove assinaturas conforme as caixas em uso"""
+    token = get_valid_token()
+    if not token:
+        subscription_state['healthy'] = False
+        return
+    
+    wanted = _wanted_subscriptions()
+    with get_db() as conn:
+        rows = {r['mailbox']: r for r in conn.execute('SELECT * FROM subscriptions').fetchall()}
+    
+    for mailbox, row in rows.items():
+        if wanted.get(mailbox) != row['resource']:
+            _delete_subscription(token, row)
+    
+    renew_before = _utcnow() + timedelta(seconds=SUBSCRIPTION_RENEW_LEAD)
+    healthy = True
+    for mailbox, resource in wanted.items():
+        row = rows.get(mailbox)
+        try:
+            if row and row['resource'] == resource:
+                if datetime.fromisoformat(row['expires_at']) > renew_before:
+                    continue
+                if _renew_subscription(token, row):
+                    continue
+            _create_subscription(token, mailbox, resource)
+        except (GraphError, requests.RequestException) as e:
+            healthy = False
+            print(f"❌ Erro na assinatura de {mailbox}: {e}")
+    
+    subscription_state['healthy'] = healthy
+
+def subscription_manager():
+    """Mantém as assinaturas de notificação do Graph em dia"""
+    delay = 5  # dá tempo do Flask subir: o Graph valida a URL ao assinar
+    while True:
+        subscription_wakeup.wait(delay)
+        subscription_wakeup.clear()
+        try:
+            sync_subscriptions()
+        except Exception as e:
+            subscription_state['healthy'] = False
+            print(f"❌ Erro mantendo assinaturas: {e}")
+        delay = SUBSCRIPTION_CHECK_INTERVAL if subscription_state['healthy'] else SUBSCRIPTION_RETRY
+
+def handle_notifications(payload):
+    """Confere o clientState e agenda a re-sincronização das caixas afetadas"""
+    with get_db() as conn:
+        rows = {r['subscription_id']: r for r in conn.execute('SELECT * FROM subscriptions').fetchall()}
+    
+    accepted = 0
+    for n in payload.get('value', []):
+        row = rows.get(n.get('subscriptionId'))
+        if not row or not secrets.compare_digest(str(n.get('clientState', '')), row['client_state']):
+            print("⚠️ Notificação ignorada: assinatura desconhecida ou clientState inválido")
+            continue
+        
+        if n.get('lifecycleEvent'):
+            # reauthorizationRequired / subscriptionRemoved / missed: renova
+            # (ou recria) já e re-sincroniza para cobrir o que se perdeu
+            print(f"♻️ Evento de ciclo de vida: {n['lifecycleEvent']} ({row['mailbox']})")
+            with get_db() as conn:
+                conn.execute('UPDATE subscriptions SET expires_at = ? WHERE subscription_id = ?',
+                             (_utcnow().isoformat(), row['subscription_id']))
+            subscription_wakeup.set()
+        
+        with _notify_lock:
+            _notify_pending.add(row['mailbox'])
+        accepted += 1
+    
+    if accepted:
+        _notify_event.set()
+    return accepted
+
+def resync_mailbox(mailbox):
+    """Re-sincroniza só os grupos que exibem a caixa alterada"""
+    events_cache.invalidate(mailbox)
+    
+    targets = [group_id for group_id, g in approved_groups().items()
+               if (resolve_mailbox(g['mailbox'])[1] or 'me') == mailbox]
+    print(f"\n🔔 Alteração em {mailbox}: {len(targets)} grupo(s)")
+    for group_id in targets:
+        sync_scheduler.trigger(group_id)
+
+def notification_worker():
+    """Processa as caixas notificadas, juntando rajadas de alterações"""
+    while True:
+        _notify_event.wait()
+        time.sleep(NOTIFICATION_DEBOUNCE)
+        _notify_event.clear()
+        
+        with _notify_lock:
+            mailboxes = set(_notify_pending)
+            _notify_pending.clear()
+        
+        for mailbox in mailboxes:
+            try:
+                resync_mailbox(mailbox)
+            except Exception as e:
+                print(f"❌ Erro re-sincronizando {mailbox}: {e}")
+
+if NOTIFICATION_URL:
+    threading.Thread(target=subscription_manager, daemon=True).start()
+    threading.Thread(target=notification_worker, daemon=True).start()
+
+# ============================================================================
+# SINCRONIZAÇÃO EM MASSA (JOBS EM BACKGROUND)
+# ============================================================================
+
+sync_executor = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='sync')
+
+class SyncJob:
+    """Progresso de uma sincronização de todos os grupos"""
+    
+    def __init__(self, groups):
+        self.id = secrets.token_urlsafe(8)
+        self.groups = groups
+        self.status = 'running'
+        self.groups_done = 0
+        self.devices_synced = 0
+        self.failed = 0
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self._lock = threading.Lock()
+    
+    def record(self, group, success):
+        with self._lock:
+            self.groups_done += 1
+            if success:
+                self.devices_synced += len(group['devices'])
+            else:
+                self.failed += 1
+    
+    def to_dict(self):
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'groups_total': len(self.groups),
+                'groups_done': self.groups_done,
+                'devices_total': sum(len(g['devices']) for g in self.groups.values()),
+                'devices_synced': self.devices_synced,
+                'failed': self.failed,
+                'started_at': self.started_at.isoformat(),
+                'finished_at': self.finished_at.isoformat() if self.finished_at else None
+            }
+
+_jobs_lock = threading.Lock()
+sync_jobs = {}
+
+def _run_sync_job(job):
+    prefetch_events((g['mailbox'], g['timezone']) for g in job.groups.values())
+    
+    futures = {sync_executor.submit(mqtt_manager.sync_group, g['mailbox'], g['timezone'], g['format'], True): g
+               for g in job.groups.values()}
+    for future in as_completed(futures):
+        try:
+            success = future.result()
+        except Exception as e:
+            print(f"❌ Erro sincronizando grupo: {e}")
+            success = False
+        job.record(futures[future], success)
+    
+    with job._lock:
+        job.finished_at = datetime.now()
+        job.status = 'done'
+    print(f"✅ Job {job.id}: {job.devices_synced} dispositivo(s), {job.failed} grupo(s) com falha")
+
+def start_sync_job():
+    """Inicia (ou reaproveita, se já houver um rodando) o job de sincronização geral"""
+    with _jobs_lock:
+        now = datetime.now()
+        for job_id, job in list(sync_jobs.items()):
+            with job._lock:
+                status, finished_at = job.status, job.finished_at
+            if status == 'running':
+                return job
+            if (now - finished_at).total_seconds() > SYNC_JOB_TTL:
+                del sync_jobs[job_id]
+        
+        job = SyncJob(approved_groups())
+        sync_jobs[job.id] = job
+    
+    print(f"\n📡 Job {job.id}: {len(job.groups)} grupo(s)")
+    threading.Thread(target=_run_sync_job, args=(job,), daemon=True).start()
+    return job
+
 # ============================================================================
 # ROTAS DA API
 # ============================================================================
@@ -468,25 +2124,20 @@ def save_config():
     if 'clientId' not in cfg:
         return jsonify({'error': 'Client ID obrigatório'}), 400
     
-    conn = get_db()
-    
     # Detecta o modo automaticamente
     has_secret = bool(cfg.get('clientSecret'))
     
-    conn.execute('''UPDATE config SET 
-                    client_id = ?, 
-                    tenant_id = ?,
-                    client_secret = ?,
-                    user_email = ?,
-                    auth_mode = ?
-                    WHERE id = 1''',
-                (cfg['clientId'],
-                 cfg.get('tenantId', 'common'),
-                 cfg.get('clientSecret'),
-                 cfg.get('userEmail'),
-                 'application' if has_secret else 'delegated'))
-    conn.commit()
-    conn.close()
+    config_cache.update(
+        client_id=cfg['clientId'],
+        tenant_id=cfg.get('tenantId', 'common'),
+        client_secret=cfg.get('clientSecret'),
+        user_email=cfg.get('userEmail'),
+        auth_mode='application' if has_secret else 'delegated'
+    )
+    
+    events_cache.clear()
+    clear_subscriptions()
+    token_renewer_wakeup.set()
     
     mode = 'Application Permissions' if has_secret else 'Delegated Permissions'
     print(f"✅ Configuração salva - Modo: {mode}")
@@ -498,9 +2149,7 @@ def save_config():
 
 @app.route('/api/config', methods=['GET'])
 def get_config():
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
-    conn.close()
+    cfg = config_cache.get()
     
     mode, mode_desc = detect_auth_mode()
     
@@ -518,13 +2167,13 @@ def get_config():
 
 @app.route('/api/status')
 def status():
-    conn = get_db()
-    cfg = conn.execute('SELECT * FROM config WHERE id = 1').fetchone()
-    dc = conn.execute('SELECT COUNT(*) as count FROM devices').fetchone()
-    ac = conn.execute('SELECT COUNT(*) as count FROM devices WHERE status = "approved"').fetchone()
-    conn.close()
+    cfg = config_cache.get()
+    with get_db() as conn:
+        dc = conn.execute('SELECT COUNT(*) as count FROM devices').fetchone()
+        ac = conn.execute('SELECT COUNT(*) as count FROM devices WHERE status = "approved"').fetchone()
     
     mode, mode_desc = detect_auth_mode()
+    seen = presence.counts(approved_devices['ids'])
     
     return jsonify({
         'online': True,
@@ -537,6 +2186,13 @@ def status():
         'user_email': cfg['user_email'] if cfg else None,
         'devices_total': dc['count'],
         'devices_approved': ac['count'],
+        'devices_online': seen['online'],
+        'devices_offline': seen['offline'],
+        'delivery_latency_ms': delivery.summary(approved_devices['ids']),
+        'graph_circuit_open': graph.throttle.is_open(),
+        'scheduler': sync_scheduler.stats(),
+        'notifications_enabled': bool(NOTIFICATION_URL),
+        'notifications_healthy': subscription_state['healthy'],
         'auth_mode': mode,
         'auth_mode_description': mode_desc
     })
@@ -597,15 +2253,12 @@ def callback():
             scopes=DELEGATED_SCOPES, 
             redirect_uri=REDIRECT_URI
         )
+        save_msal_cache(app_msal)
         
         if "access_token" in result:
             # Obtém informações do usuário
             try:
-                user_res = requests.get(
-                    f"{GRAPH_ENDPOINT}me", 
-                    headers={'Authorization': f'Bearer {result["access_token"]}'}, 
-                    timeout=10
-                )
+                user_res = graph.get("me", result["access_token"])
                 user_data = user_res.json() if user_res.status_code == 200 else {}
             except:
                 user_data = {}
@@ -616,24 +2269,17 @@ def callback():
             expires_in = result.get('expires_in', 3600)
             expires_at = (datetime.now() + timedelta(seconds=expires_in)).isoformat()
             
-            conn = get_db()
-            conn.execute('''UPDATE config SET 
-                            access_token = ?, 
-                            refresh_token = ?, 
-                            expires_at = ?,
-                            user_email = ?,
-                            user_name = ?,
-                            auth_mode = ?
-                            WHERE id = 1''',
-                        (result['access_token'],
-                         result.get('refresh_token'),
-                         expires_at,
-                         user_email,
-                         user_name,
-                         'delegated'))
-            conn.commit()
-            conn.close()
+            config_cache.update(
+                access_token=result['access_token'],
+                refresh_token=result.get('refresh_token'),
+                expires_at=expires_at,
+                user_email=user_email,
+                user_name=user_name,
+                auth_mode='delegated'
+            )
             
+            token_renewer_wakeup.set()
+            subscription_wakeup.set()
             print(f"✅ Login concluído: {user_name} ({user_email})\n")
             
             return '''
@@ -670,33 +2316,36 @@ def callback():
 
 @app.route('/api/logout', methods=['POST'])
 def logout():
-    conn = get_db()
-    conn.execute('''UPDATE config SET 
-                    access_token = NULL, 
-                    refresh_token = NULL, 
-                    user_email = NULL, 
-                    user_name = NULL 
-                    WHERE id = 1''')
-    conn.commit()
-    conn.close()
+    config_cache.update(
+        access_token=None,
+        refresh_token=None,
+        user_email=None,
+        user_name=None,
+        msal_cache=None
+    )
+    reset_msal_app()
+    events_cache.clear()
+    clear_subscriptions()
+    token_renewer_wakeup.set()
     print("👋 Logout realizado")
     return jsonify({'success': True})
 
 @app.route('/api/events')
 def events():
-    evts = get_today_events()
+    tz = request.args.get('tz')
+    evts = get_today_events(tz=tz)
     return jsonify({
         'success': True,
         'events': evts,
         'count': len(evts),
-        'date': datetime.now().strftime('%Y-%m-%d')
+        'date': local_today(tz).isoformat(),
+        'timezone': resolve_timezone(tz)[0]
     })
 
 @app.route('/api/devices')
 def devices():
-    conn = get_db()
-    devs = conn.execute('SELECT * FROM devices ORDER BY last_seen DESC').fetchall()
-    conn.close()
+    with get_db() as conn:
+        devs = conn.execute('SELECT * FROM devices ORDER BY last_seen DESC').fetchall()
     
     return jsonify({
         'success': True,
@@ -706,59 +2355,265 @@ def devices():
             'status': d['status'],
             'device_info': d['device_info'],
             'mac_address': d['mac_address'],
+            'mailbox': d['mailbox'],
+            'timezone': d['timezone'],
+            'timezone_source': d['timezone_source'] or 'device',
+            'group_id': device_group_id(d['mailbox'], d['timezone'], d['payload_format']),
+            'payload_format': d['payload_format'] or 'json',
+            'online': presence.status(d['registration_id']),
+            'online_since': presence.since(d['registration_id']),
             'first_seen': d['first_seen'],
             'last_seen': d['last_seen']
         } for d in devs],
         'count': len(devs)
     })
 
+@app.route('/api/delivery')
+def delivery_status():
+    """Latência publish -> ack (percentis) e dispositivos aprovados sem ack da última versão"""
+    with get_db() as conn:
+        devs = conn.execute('''SELECT registration_id, device_id, mailbox, timezone, payload_format
+                               FROM devices WHERE status = "approved"''').fetchall()
+    
+    devices, unacked = [], []
+    for d in devs:
+        group_id = device_group_id(d['mailbox'], d['timezone'], d['payload_format'])
+        waiting = delivery.pending(d['registration_id'], group_id)
+        devices.append({
+            'registration_id': d['registration_id'],
+            'device_id': d['device_id'],
+            'group_id': group_id,
+            'online': presence.status(d['registration_id']),
+            'pending_since': waiting.isoformat() if waiting else None,
+            **delivery.device(d['registration_id'])
+        })
+        if waiting:
+            unacked.append(devices[-1])
+    
+    return jsonify({
+        'success': True,
+        'latency_ms': delivery.summary([d['registration_id'] for d in devs]),
+        'ack_timeout': ACK_TIMEOUT,
+        'devices': devices,
+        'unacked': unacked
+    })
+
+@app.route('/api/devices/<device_id>/mailbox', methods=['POST'])
+def set_device_mailbox(device_id):
+    """Define qual caixa de correio o dispositivo exibe (modo application)"""
+    data = request.get_json() or {}
+    mailbox = (data.get('mailbox') or '').strip() or None
+    
+    with get_db() as conn:
+        cur = conn.execute('UPDATE devices SET mailbox = ? WHERE device_id = ?', (mailbox, device_id))
+    
+    if cur.rowcount == 0:
+        return jsonify({'success': False, 'error': 'Dispositivo não encontrado'}), 404
+    
+    subscription_wakeup.set()
+    threading.Thread(target=mqtt_manager.announce_device, args=(device_id,), daemon=True).start()
+    print(f"📬 {device_id} -> {mailbox or 'caixa padrão'}")
+    return jsonify({'success': True, 'device_id': device_id, 'mailbox': mailbox})
+
+@app.route('/api/devices/<device_id>/timezone', methods=['POST'])
+def set_device_timezone(device_id):
+    """Define o fuso do dispositivo (nome IANA ou offset em horas)"""
+    data = request.get_json() or {}
+    value = data.get('timezone')
+    tz = timezone_key(value)
+    if value not in (None, '') and not tz:
+        return jsonify({'success': False, 'error': 'Fuso horário inválido'}), 400
+    
+    # Vazio remove o fuso do admin: volta a valer o que o firmware informar
+    with get_db() as conn:
+        cur = conn.execute('UPDATE devices SET timezone = ?, timezone_source = ? WHERE device_id = ?',
+                           (tz, 'admin' if tz else None, device_id))
+    
+    if cur.rowcount == 0:
+        return jsonify({'success': False, 'error': 'Dispositivo não encontrado'}), 404
+    
+    threading.Thread(target=mqtt_manager.announce_device, args=(device_id,), daemon=True).start()
+    print(f"🕒 {device_id} -> {tz or 'fuso padrão'}")
+    return jsonify({'success': True, 'device_id': device_id, 'timezone': tz})
+
+@app.route('/api/notifications', methods=['POST'])
+def notifications():
+    """Webhook das notificações de alteração do Graph"""
+    # Validação da assinatura: o Graph espera o token de volta em texto puro
+    validation_token = request.args.get('validationToken')
+    if validation_token is not None:
+        return validation_token, 200, {'Content-Type': 'text/plain'}
+    
+    # Responde rápido (o Graph exige < 3s); a re-sincronização roda no worker
+    handle_notifications(request.get_json(silent=True) or {})
+    return '', 202
+
 @app.route('/api/sync/<device_id>', methods=['POST'])
 def sync_device(device_id):
     try:
-        success = mqtt_manager.sync_device(device_id)
+        success = mqtt_manager.sync_device(device_id, force=True)
         return jsonify({'success': success})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/sync/all', methods=['POST'])
 def sync_all():
-    conn = get_db()
-    devs = conn.execute('SELECT device_id FROM devices WHERE status = "approved"').fetchall()
-    conn.close()
-    
-    count = 0
-    for d in devs:
-        try:
-            if mqtt_manager.sync_device(d['device_id']):
-                count += 1
-            time.sleep(1)
-        except:
-            pass
-    
-    return jsonify({'success': True, 'count': count})
+    """Dispara a sincronização geral em background; o progresso fica em /api/sync/jobs/<id>"""
+    job = start_sync_job()
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f"/api/sync/jobs/{job.id}"
+    }), 202
+
+@app.route('/api/sync/jobs/<job_id>')
+def sync_job_status(job_id):
+    job = sync_jobs.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job não encontrado'}), 404
+    return jsonify({'success': True, **job.to_dict()})
 
 # ============================================================================
-# SINCRONIZAÇÃO AUTOMÁTICA
+# SINCRONIZAÇÃO AUTOMÁTICA (AGENDADOR POR PRAZO)
 # ============================================================================
 
-def auto_sync():
-    """Sincroniza todos os dispositivos a cada 15 minutos"""
-    while True:
-        time.sleep(900)  # 15 minutos
-        try:
-            conn = get_db()
-            devs = conn.execute('SELECT device_id FROM devices WHERE status = "approved"').fetchall()
-            conn.close()
+class SyncScheduler:
+    """Sincronização periódica por prazo (heap por grupo), com jitter e vazão limitada"""
+    
+    def __init__(self, rate=SYNC_RATE):
+        self._cond = threading.Condition()
+        self._heap = []        # (prazo, seq, group_id)
+        self._due = {}         # group_id -> prazo vigente (entradas antigas do heap são ignoradas)
+        self._groups = {}      # group_id -> {'mailbox', 'timezone', 'devices'}
+        self._seq = 0
+        self._bucket = TokenBucket(rate, 1)
+    
+    def _interval(self):
+        base = AUTO_SYNC_INTERVAL_WEBHOOK if subscription_state['healthy'] else AUTO_SYNC_INTERVAL
+        return base * random.uniform(1 - SYNC_JITTER, 1 + SYNC_JITTER)
+    
+    def _push(self, group_id, due):
+        self._seq += 1
+        self._due[group_id] = due
+        heapq.heappush(self._heap, (due, self._seq, group_id))
+        self._cond.notify()
+    
+    def refresh(self):
+        """Relê os grupos aprovados; grupos novos entram espalhados pelo intervalo"""
+        groups = approved_groups()
+        now = time.monotonic()
+        with self._cond:
+            for group_id in set(self._groups) - set(groups):
+                self._due.pop(group_id, None)
+            self._groups = groups
+            for group_id in groups:
+                if group_id not in self._due:
+                    self._push(group_id, now + random.uniform(0, self._interval()))
+    
+    def trigger(self, group_id):
+        """Sincroniza o grupo já (fura a fila); triggers repetidos se fundem"""
+        if group_id not in self._groups:
+            self.refresh()
+        
+        with self._cond:
+            if group_id in self._groups:
+                self._push(group_id, time.monotonic())
+    
+    def stats(self):
+        with self._cond:
+            next_due = min(self._due.values(), default=None)
+            return {
+                'groups': len(self._groups),
+                'next_due_in': round(max(0, next_due - time.monotonic()), 1) if next_due is not None else None
+            }
+    
+    def _next_due(self, timeout):
+        """Espera até 'timeout' por grupos vencidos; devolve até GRAPH_BATCH_SIZE deles"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._heap and self._due.get(self._heap[0][2]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+                
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    break
+                wait = deadline - now
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - now)
+                if wait <= 0:
+                    return []
+                self._cond.wait(wait)
             
-            if devs:
-                print(f"\n⏰ Sincronização automática: {len(devs)} dispositivo(s)")
-                for d in devs:
-                    mqtt_manager.sync_device(d['device_id'])
-                    time.sleep(2)
+            # Leva junto quem vence logo em seguida: com os prazos espalhados pelo
+            # jitter, só os vencidos neste instante raramente encheriam um $batch
+            due, busy, offline = [], [], []
+            horizon = now + SCHEDULER_BATCH_WINDOW
+            while self._heap and len(due) < GRAPH_BATCH_SIZE and self._heap[0][0] <= horizon:
+                when, _, group_id = heapq.heappop(self._heap)
+                if self._due.get(group_id) != when:
+                    continue
+                if mqtt_manager.sync_in_flight(group_id):
+                    # Juntar-se à sincronização em andamento perderia a mudança
+                    # que motivou o trigger: roda de novo quando ela terminar
+                    busy.append(group_id)
+                    continue
+                if not presence.any_listening(self._groups[group_id]['registrations']):
+                    # Ninguém ouvindo: pula; quem voltar online dispara a sincronização
+                    offline.append(group_id)
+                    continue
+                del self._due[group_id]
+                due.append((group_id, self._groups[group_id]))
+            
+            for group_id in busy:
+                self._push(group_id, now + SCHEDULER_BUSY_RETRY)
+            for group_id in offline:
+                self._push(group_id, now + self._interval())
+            return due
+    
+    def _sync(self, group_id, group, next_due):
+        try:
+            mqtt_manager.sync_group(group['mailbox'], group['timezone'], group['format'])
         except Exception as e:
-            print(f"❌ Erro na sincronização automática: {e}")
+            print(f"❌ Erro na sincronização agendada: {e}")
+        finally:
+            # Prazo comum a todo o lote, para ele continuar saindo num $batch
+            # (nunca antes do fim desta sincronização; um trigger pendente prevalece)
+            with self._cond:
+                if group_id in self._groups and group_id not in self._due:
+                    self._push(group_id, max(next_due, time.monotonic()))
+    
+    def _dispatch(self, due):
+        # Grupos vencidos juntos compartilham um $batch
+        prefetch_events((g['mailbox'], g['timezone']) for _, g in due)
+        next_due = time.monotonic() + self._interval()
+        for group_id, group in due:
+            self._bucket.acquire()
+            sync_executor.submit(self._sync, group_id, group, next_due)
+    
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+                refresh_at = time.monotonic() + SCHEDULER_REFRESH
+                while True:
+                    remaining = refresh_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    due = self._next_due(remaining)
+                    if due:
+                        self._dispatch(due)
+            except Exception as e:
+                print(f"❌ Erro no agendador de sincronização: {e}")
+                time.sleep(5)
+
+sync_scheduler = SyncScheduler()
+threading.Thread(target=sync_scheduler.run, daemon=True).start()
 
-threading.Thread(target=auto_sync, daemon=True).start()
+# Registros recebidos já usam o agendador, o executor e o webhook: conecta por último,
+# conhecendo os aprovados antes das mensagens retidas de presença chegarem
+approved_groups()
+mqtt_manager.start()
 
 # ============================================================================
 # INICIALIZAÇÃO
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+SPACE MIRROR - Mock local do Microsoft Graph
+Simula calendarView, calendarView/delta e $batch para testar a sincronização offline
+
+Uso:
+    python mock_graph.py                      # sobe em http://localhost:5001
+    GRAPH_ENDPOINT=http://localhost:5001/v1.0/ python app.py
+
+O mock aceita qualquer Bearer token; grave um access_token qualquer com
+expires_at no futuro na tabela config para o app.py não chamar o MSAL.
+
+Alterar eventos:
+    POST   /mock/events          {"subject": "...", "start": "2025-01-01T10:00:00", "isAllDay": false}
+    PATCH  /mock/events/<id>     campos a alterar
+    DELETE /mock/events/<id>
+
+Simular throttling (as próximas N chamadas ao Graph respondem 429):
+    POST   /mock/throttle        {"count": 5, "retry_after": 2}
+
+Notificações de alteração: POST /v1.0/subscriptions valida a notificationUrl
+(eco do validationToken) e cada alteração em /mock/events é notificada.
+    GET    /mock/subscriptions
+    POST   /mock/notify          {"subscription_id": "...", "clientState": "...", "lifecycleEvent": "..."}
+"""
+import secrets
+import threading
+
+from flask import Flask, request, jsonify
+import requests
+
+app = Flask(__name__)
+
+MOCK_PORT = 5001
+PAGE_SIZE = 10
+
+# Log de alterações: cada mudança recebe um número de sequência; o delta
+# token devolvido ao cliente é a última sequência que ele já viu
+_lock = threading.Lock()
+_events = {}       # id -> evento no formato do Graph
+_changes = []      # (seq, id, removed)
+_seq = 0
+_throttle = {'count': 0, 'retry_after': 1}
+_subscriptions = {}  # id -> assinatura
+
+def _record(event_id, removed=False):
+    global _seq
+    _seq += 1
+    _changes.append((_seq, event_id, removed))
+
+def _graph_event(data, event_id=None):
+    return {
+        'id': event_id or secrets.token_hex(8),
+        'subject': data.get('subject', 'Sem título'),
+        'start': {'dateTime': data.get('start', '2025-01-01T09:00:00'), 'timeZone': 'UTC'},
+        'end': {'dateTime': data.get('end', data.get('start', '2025-01-01T10:00:00')), 'timeZone': 'UTC'},
+        'isAllDay': bool(data.get('isAllDay', False))
+    }
+
+def _in_window(event, start, end):
+    if not start or not end:
+        return True
+    begin = event['start']['dateTime']
+    return start.rstrip('Z')[:19] <= begin[:19] <= end.rstrip('Z')[:19]
+
+def _delta_items(since, start, end):
+    """Eventos alterados depois de 'since' (todos, na sincronização inicial)"""
+    if since == 0:
+        return [e for e in _events.values() if _in_window(e, start, end)]
+
+    latest = {}
+    for seq, event_id, removed in _changes:
+        if seq > since:
+            latest[event_id] = removed
+
+    items = []
+    for event_id, removed in latest.items():
+        if removed or event_id not in _events:
+            items.append({'id': event_id, '@removed': {'reason': 'deleted'}})
+        elif _in_window(_events[event_id], start, end):
+            items.append(_events[event_id])
+    return items
+
+def _page_size():
+    """Honra o header Prefer: odata.maxpagesize=N como o Graph"""
+    prefer = request.headers.get('Prefer', '')
+    if 'odata.maxpagesize=' in prefer:
+        return int(prefer.split('odata.maxpagesize=')[1].split(',')[0])
+    return PAGE_SIZE
+
+@app.before_request
+def simulate_throttling():
+    if not request.path.startswith('/v1.0/'):
+        return None
+    with _lock:
+        if _throttle['count'] <= 0:
+            return None
+        _throttle['count'] -= 1
+        retry_after = _throttle['retry_after']
+    print(f"🚦 429 simulado (Retry-After: {retry_after})")
+    res = jsonify({'error': {'code': 'TooManyRequests', 'message': 'Simulated throttling'}})
+    res.status_code = 429
+    res.headers['Retry-After'] = str(retry_after)
+    return res
+
+@app.route('/v1.0/me/calendarView/delta')
+@app.route('/v1.0/users/<user>/calendarView/delta')
+def calendar_view_delta(user=None):
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'error': {'code': 'InvalidAuthenticationToken'}}), 401
+
+    start = request.args.get('startDateTime')
+    end = request.args.get('endDateTime')
+    since = int(request.args.get('$deltatoken', 0))
+    skip = int(request.args.get('$skiptoken', 0))
+    page_size = _page_size()
+
+    with _lock:
+        items = _delta_items(since, start, end)
+        seq = _seq
+
+    base = request.base_url
+    window = f"startDateTime={start}&endDateTime={end}"
+    page = items[skip:skip + page_size]
+    body = {'value': page}
+
+    if skip + page_size < len(items):
+        body['@odata.nextLink'] = f"{base}?{window}&$deltatoken={since}&$skiptoken={skip + page_size}"
+    else:
+        body['@odata.deltaLink'] = f"{base}?{window}&$deltatoken={seq}"
+
+    print(f"📤 delta since={since} -> {len(page)} item(s)")
+    return jsonify(body)
+
+@app.route('/v1.0/me/calendarView')
+@app.route('/v1.0/users/<user>/calendarView')
+def calendar_view(user=None):
+    """Consulta completa da janela, paginada por $top/$skip"""
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'error': {'code': 'InvalidAuthenticationToken'}}), 401
+
+    start = request.args.get('startDateTime')
+    end = request.args.get('endDateTime')
+    top = int(request.args.get('$top', PAGE_SIZE))
+    skip = int(request.args.get('$skip', 0))
+
+    with _lock:
+        items = sorted((e for e in _events.values() if _in_window(e, start, end)),
+                       key=lambda e: e['start']['dateTime'])
+
+    body = {'value': items[skip:skip + top]}
+    if skip + top < len(items):
+        window = f"startDateTime={start}&endDateTime={end}"
+        body['@odata.nextLink'] = f"{request.base_url}?{window}&$top={top}&$skip={skip + top}"
+
+    print(f"📤 calendarView skip={skip} -> {len(body['value'])} item(s)")
+    return jsonify(body)
+
+def _post_notifications(sub, notifications):
+    try:
+        requests.post(sub['notificationUrl'], json={'value': notifications}, timeout=5)
+    except requests.RequestException as e:
+        print(f"❌ Falha ao notificar {sub['notificationUrl']}: {e}")
+
+def _notify(change_type, event_id):
+    """Envia a notificação de alteração a todas as assinaturas (em background)"""
+    with _lock:
+        subs = list(_subscriptions.values())
+    for sub in subs:
+        notification = {
+            'subscriptionId': sub['id'],
+            'clientState': sub['clientState'],
+            'changeType': change_type,
+            'resource': f"{sub['resource']}/{event_id}",
+            'subscriptionExpirationDateTime': sub['expirationDateTime']
+        }
+        threading.Thread(target=_post_notifications, args=(sub, [notification]), daemon=True).start()
+    if subs:
+        print(f"🔔 {change_type} notificado a {len(subs)} assinatura(s)")
+
+@app.route('/v1.0/subscriptions', methods=['POST'])
+def create_subscription():
+    if not request.headers.get('Authorization', '').startswith('Bearer '):
+        return jsonify({'error': {'code': 'InvalidAuthenticationToken'}}), 401
+
+    data = request.get_json() or {}
+
+    # Como o Graph: a notificationUrl precisa ecoar o validationToken
+    token = secrets.token_hex(8)
+    try:
+        res = requests.post(data['notificationUrl'], params={'validationToken': token}, timeout=10)
+        valid = res.status_code == 200 and res.text == token
+    except requests.RequestException:
+        valid = False
+    if not valid:
+        return jsonify({'error': {'code': 'ValidationError',
+                                  'message': 'Subscription validation request failed'}}), 400
+
+    sub = {
+        'id': secrets.token_hex(8),
+        'resource': data.get('resource'),
+        'changeType': data.get('changeType'),
+        'notificationUrl': data['notificationUrl'],
+        'clientState': data.get('clientState'),
+        'expirationDateTime': data.get('expirationDateTime')
+    }
+    with _lock:
+        _subscriptions[sub['id']] = sub
+    print(f"🔔 Assinatura criada: {sub['resource']}")
+    return jsonify(sub), 201
+
+@app.route('/v1.0/subscriptions/<sub_id>', methods=['PATCH'])
+def renew_subscription(sub_id):
+    with _lock:
+        if sub_id not in _subscriptions:
+            return jsonify({'error': {'code': 'ResourceNotFound'}}), 404
+        _subscriptions[sub_id]['expirationDateTime'] = (request.get_json() or {}).get('expirationDateTime')
+        sub = dict(_subscriptions[sub_id])
+    print(f"🔁 Assinatura renovada: {sub['resource']}")
+    return jsonify(sub)
+
+@app.route('/v1.0/subscriptions/<sub_id>', methods=['DELETE'])
+def delete_subscription(sub_id):
+    with _lock:
+        _subscriptions.pop(sub_id, None)
+    return '', 204
+
+@app.route('/v1.0/$batch', methods=['POST'])
+def batch():
+    """Executa cada sub-requisição GET no próprio mock e agrupa as respostas"""
+    data = request.get_json() or {}
+    sub_requests = data.get('requests', [])
+    if len(sub_requests) > 20:
+        return jsonify({'error': {'code': 'BadRequest', 'message': 'Limite de 20 requisições'}}), 400
+
+    client = app.test_client()
+    responses = []
+    for sub in sub_requests:
+        res = client.get('/v1.0' + sub['url'], base_url=request.host_url, headers={
+            'Authorization': request.headers.get('Authorization', ''),
+            **sub.get('headers', {})
+        })
+        responses.append({
+            'id': sub['id'],
+            'status': res.status_code,
+            'headers': dict(res.headers),
+            'body': res.get_json()
+        })
+
+    print(f"📦 $batch com {len(sub_requests)} requisição(ões)")
+    return jsonify({'responses': responses})
+
+@app.route('/mock/events', methods=['POST'])
+def add_event():
+    with _lock:
+        event = _graph_event(request.get_json() or {})
+        _events[event['id']] = event
+        _record(event['id'])
+    _notify('created', event['id'])
+    return jsonify(event), 201
+
+@app.route('/mock/events/<event_id>', methods=['PATCH'])
+def update_event(event_id):
+    with _lock:
+        if event_id not in _events:
+            return jsonify({'error': 'not found'}), 404
+        data = request.get_json() or {}
+        current = _events[event_id]
+        merged = {
+            'subject': data.get('subject', current['subject']),
+            'start': data.get('start', current['start']['dateTime']),
+            'end': data.get('end', current['end']['dateTime']),
+            'isAllDay': data.get('isAllDay', current['isAllDay'])
+        }
+        _events[event_id] = event = _graph_event(merged, event_id)
+        _record(event_id)
+    _notify('updated', event_id)
+    return jsonify(event)
+
+@app.route('/mock/events/<event_id>', methods=['DELETE'])
+def delete_event(event_id):
+    with _lock:
+        _events.pop(event_id, None)
+        _record(event_id, removed=True)
+    _notify('deleted', event_id)
+    return jsonify({'success': True})
+
+@app.route('/mock/throttle', methods=['POST'])
+def set_throttle():
+    data = request.get_json() or {}
+    with _lock:
+        _throttle['count'] = int(data.get('count', 0))
+        _throttle['retry_after'] = int(data.get('retry_after', 1))
+    return jsonify({'success': True, **_throttle})
+
+@app.route('/mock/subscriptions')
+def list_subscriptions():
+    with _lock:
+        return jsonify({'value': list(_subscriptions.values())})
+
+@app.route('/mock/notify', methods=['POST'])
+def send_notification():
+    """Posta uma notificação arbitrária (ex.: clientState errado ou lifecycleEvent)"""
+    data = request.get_json() or {}
+    with _lock:
+        sub = _subscriptions.get(data.get('subscription_id')) or next(iter(_subscriptions.values()), None)
+    if not sub:
+        return jsonify({'error': 'nenhuma assinatura'}), 404
+
+    notification = {
+        'subscriptionId': sub['id'],
+        'clientState': data.get('clientState', sub['clientState']),
+        'resource': sub['resource']
+    }
+    if data.get('lifecycleEvent'):
+        notification['lifecycleEvent'] = data['lifecycleEvent']
+    else:
+        notification['changeType'] = data.get('changeType', 'updated')
+    _post_notifications(sub, [notification])
+    return jsonify({'success': True, 'notification': notification})
+
+@app.route('/mock/events')
+def list_events():
+    with _lock:
+        return jsonify({'value': list(_events.values()), 'seq': _seq})
+
+if __name__ == '__main__':
+    print(f"🧪 Mock Graph em http://localhost:{MOCK_PORT}/v1.0/")
+    app.run(host='0.0.0.0', port=MOCK_PORT, debug=False, threaded=True)